@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""Benchmarks BBReport on generated Building Blocks of increasing size, see bbgenerate.py."""
+
+# import builtins
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+# import our own
+import bbgenerate
+
+# Authorship information
+__author__ = "Maarten van der Woord"
+__copyright__ = "Copyright 2017, Maarten van der Woord"
+__credits__ = ["Maarten van der Woord"]
+__license__ = "GNU GENERAL PUBLIC LICENSE Version 3"
+__version__ = "0.1"
+__maintainer__ = "Maarten van der Woord"
+__email__ = "maarten@vanderwoord.nl"
+__status__ = "Development"
+
+basedir = os.path.dirname(os.path.abspath(__file__))
+
+
+def benchmark(modules, tasks, workfolder, options):
+    """Generates a Building Block with this many modules if needed, reports it and returns the results
+
+    Every report runs in a fresh interpreter so the peak memory belongs to that size alone."""
+    bb = os.path.join(workfolder, 'bench-{}x{}.xml'.format(modules, tasks))
+    if not os.path.exists(bb):
+        bbgenerate.generate_buildingblock(modules, tasks).write(bb, encoding='utf-8', xml_declaration=True)
+    output_folder = os.path.join(workfolder, 'output-{}'.format(modules))
+    command = [sys.executable, os.path.join(basedir, 'bbreport.py'), '--profile',
+               '-f', bb, '-o', output_folder] + options
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    with open(os.path.join(output_folder, 'profile.json'), 'rt', encoding='utf-8') as file:
+        profile = json.load(file)
+
+    stages = {stage['name']: stage for stage in profile['stages']}
+    # Every page goes through one write, whether it ran in this process or a worker. None with --no-html.
+    pages = stages.get('render/write', {}).get('count', 0)
+    render = stages.get('render', {}).get('wall', 0)
+    total = sum(stage['wall'] for name, stage in stages.items() if '/' not in name)
+    return {
+        'modules': modules,
+        'tasks': tasks,
+        'size': os.path.getsize(bb),
+        'pages': pages,
+        'wall': total,
+        'pages_per_second': pages / render if render else 0,
+        'peak_rss_kb': profile['peak_rss_kb'],
+        'stages': {name: stage['wall'] for name, stage in stages.items()}
+    }
+
+
+def print_results(results, baseline=None):
+    """Prints a table of the results, with the change in throughput against a baseline if given"""
+    previous = {}
+    if baseline is not None:
+        previous = {result['modules']: result for result in baseline}
+    stages = sorted(set(name for result in results for name in result['stages']))
+    print('{:>8}{:>10}{:>8}{:>10}{:>10}{:>11}'.format('Modules', 'Size (MB)', 'Pages', 'Wall (s)', 'Pages/s',
+                                                    'Peak (MB)'))
+    for result in results:
+        line = '{:>8}{:>10.1f}{:>8}{:>10.2f}{:>10.1f}{:>11.1f}'.format(
+            result['modules'], result['size'] / 1048576, result['pages'], result['wall'],
+            result['pages_per_second'], (result['peak_rss_kb'] or 0) / 1024)
+        if result['modules'] in previous:
+            before = previous[result['modules']]['pages_per_second']
+            line += '  {:+.1%}'.format(result['pages_per_second'] / before - 1 if before else 0)
+        print(line)
+    print('')
+    print('{:<28}'.format('Stage wall (s)') + ''.join('{:>10}'.format(result['modules']) for result in results))
+    for name in stages:
+        label = '  ' * name.count('/') + name.split('/')[-1]
+        print('{:<28}'.format(label) +
+              ''.join('{:>10.3f}'.format(result['stages'].get(name, 0)) for result in results))
+
+
+def main():
+    """Main function, checks for arguments and runs the benchmarks."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--modules',
+                        default='100,1000,10000',
+                        metavar='N,N,...',
+                        help='Sizes to benchmark in modules (default 100,1000,10000)')
+
+    parser.add_argument('-t', '--tasks',
+                        type=int,
+                        default=10,
+                        help='Number of tasks per module (default 10)')
+
+    parser.add_argument('-w', '--workfolder',
+                        default=os.path.join(tempfile.gettempdir(), 'bbbench'),
+                        metavar='<folder>',
+                        help='Generated Building Blocks are kept here for the next run')
+
+    parser.add_argument('--json',
+                        metavar='<file>',
+                        help='Write the results to this file, to compare against later')
+
+    parser.add_argument('--compare',
+                        metavar='<file>',
+                        help='Show the change in pages per second against results written with --json')
+
+    parser.add_argument('options',
+                        nargs=argparse.REMAINDER,
+                        help='Further options for bbreport.py, e.g. -- --jobs 4 --stream')
+    args = parser.parse_args()
+    options = [option for option in args.options if option != '--']
+    os.makedirs(args.workfolder, exist_ok=True)
+
+    results = []
+    for modules in [int(size) for size in args.modules.split(',')]:
+        results.append(benchmark(modules, args.tasks, args.workfolder, options))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'rt', encoding='utf-8') as file:
+            baseline = json.load(file)
+    print_results(results, baseline)
+    if args.json:
+        with open(args.json, 'wt', encoding='utf-8') as file:
+            json.dump(results, file, indent=1)
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    main()
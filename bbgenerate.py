@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+"""Generates synthetic RESAM Building Blocks (XML) of configurable size, for benchmarking BBReport."""
+
+# import builtins
+import argparse
+import base64
+import binascii
+import random
+import uuid
+import zlib
+
+# import 3rd party
+from lxml import etree
+
+# Authorship information
+__author__ = "Maarten van der Woord"
+__copyright__ = "Copyright 2017, Maarten van der Woord"
+__credits__ = ["Maarten van der Woord"]
+__license__ = "GNU GENERAL PUBLIC LICENSE Version 3"
+__version__ = "0.1"
+__maintainer__ = "Maarten van der Woord"
+__email__ = "maarten@vanderwoord.nl"
+__status__ = "Development"
+
+# Every task type task_to_dict knows about, generated round robin
+task_types = [
+    'PWRSHELL',
+    'COMMAND',
+    'DOWNLOAD',
+    'SHUTDOWN',
+    'REGISTRY',
+    'FILEOPERATIONS',
+    'SECURITY',
+    'LINUX_COMMAND',
+    'LINUX_DOWNLOAD'
+]
+
+resource_types = ['DATABASE', 'FILESHARE', 'URLRESOURCE', 'AMRESOURCEPACKAGE']
+
+# Script bodies are built from these lines, repeated to the requested length
+script_lines = {
+    'cmd': ['@echo off', 'set LOGFILE=%TEMP%\\install.log', 'msiexec /i "%~dp0setup.msi" /qn /l*v %LOGFILE%',
+            'if errorlevel 1 goto :error', 'reg add HKLM\\Software\\Contoso /v Installed /t REG_DWORD /d 1 /f'],
+    'sh': ['#!/bin/sh', 'set -e', 'LOG=/var/log/install.log', 'yum -y install httpd >> $LOG 2>&1',
+           'systemctl enable httpd', 'if [ ! -d /opt/contoso ]; then mkdir -p /opt/contoso; fi'],
+    'ps1': ['$ErrorActionPreference = "Stop"', 'Import-Module ServerManager',
+            'Get-ChildItem -Path C:\\Temp -Recurse | Where-Object { $_.Length -gt 1MB } | Remove-Item',
+            'Install-WindowsFeature -Name Web-Server -IncludeManagementTools',
+            'Set-ItemProperty -Path HKLM:\\Software\\Contoso -Name Installed -Value 1']
+}
+
+
+def generate_buildingblock(modules=100, tasks=10, projects=None, resources=None, script_lines_count=20,
+                           unique_scripts=0.25, resource_size=4096, seed=1):
+    """Returns an ElementTree of a Building Block with the given number of modules and tasks per module
+
+    Projects and resources default to a tenth of the modules. unique_scripts is the fraction of scripts
+    and registry files that differ from all others, the rest is shared the way real estates copy them.
+    Embedded resources carry a PowerShell script of about resource_size bytes."""
+    rng = random.Random(seed)
+    projects = max(1, modules // 10) if projects is None else projects
+    resources = max(1, modules // 10) if resources is None else resources
+
+    def guid():
+        return '{' + str(uuid.UUID(int=rng.getrandbits(128))).upper() + '}'
+
+    def script(ext):
+        # Shared scripts come from a small pool so the same body shows up in many modules
+        variant = rng.randrange(1 << 30) if rng.random() < unique_scripts else rng.randrange(10)
+        lines = script_lines[ext]
+        body = [lines[(variant + i) % len(lines)] for i in range(script_lines_count)]
+        return '\n'.join(['# variant {}'.format(variant)] + body) + '\n'
+
+    root = etree.Element('xml')
+    buildingblock = etree.SubElement(root, 'buildingblock')
+    resourceroot = etree.SubElement(buildingblock, 'resources')
+    moduleroot = etree.SubElement(buildingblock, 'modules')
+    projectroot = etree.SubElement(buildingblock, 'projects')
+
+    resourceguids = [guid() for i in range(resources)]
+    moduleguids = [guid() for i in range(modules)]
+    projectguids = [guid() for i in range(projects)]
+
+    for i, resourceguid in enumerate(resourceguids):
+        resource_element(resourceroot, resourceguid, resource_types[i % len(resource_types)], i, resource_size)
+
+    for i, moduleguid in enumerate(moduleguids):
+        module = etree.SubElement(moduleroot, 'module')
+        properties = etree.SubElement(module, 'properties')
+        common_properties(properties, moduleguid, 'Module {:05d}'.format(i), i)
+        tasksroot = etree.SubElement(module, 'tasks')
+        # RES keeps the module parameters in a hidden first task
+        hidden = etree.SubElement(tasksroot, 'task', hidden='yes')
+        task_properties(hidden, 'PARAMETERS', guid())
+        parameters = etree.SubElement(hidden, 'parameters')
+        for p in range(3):
+            # Every other module links a parameter to the previous module
+            target = ('module', moduleguids[i - 1]) if p == 2 and i > 0 else None
+            parameter_element(parameters, 'Parameter{}'.format(p), p, target)
+        for t in range(tasks):
+            tasktype = task_types[(i + t) % len(task_types)]
+            task_element(tasksroot, tasktype, guid(), rng, script, resourceguids)
+
+    for i, projectguid in enumerate(projectguids):
+        project = etree.SubElement(projectroot, 'project')
+        properties = etree.SubElement(project, 'properties')
+        common_properties(properties, projectguid, 'Project {:05d}'.format(i), i)
+        parameters = etree.SubElement(properties, 'parameters')
+        for p in range(2):
+            target = ('module', moduleguids[rng.randrange(modules)])
+            if p == 1 and projects > 1:
+                target = ('project', projectguids[(i + 1) % projects])
+            parameter_element(parameters, 'ProjectParameter{}'.format(p), p, target)
+        projectmodules = etree.SubElement(project, 'modules')
+        for moduleguid in rng.sample(moduleguids, min(modules, 5)):
+            projectmodule = etree.SubElement(projectmodules, 'module')
+            text_element(projectmodule, 'guid', moduleguid)
+            text_element(projectmodule, 'enabled', rng.choice(['yes', 'yes', 'no']))
+
+    return etree.ElementTree(root)
+
+
+def text_element(parent, tag, text, **attributes):
+    """Adds a child element with text and returns it"""
+    element = etree.SubElement(parent, tag, **attributes)
+    element.text = text
+    return element
+
+
+def common_properties(properties, guid, name, i):
+    """Adds the properties modules and projects share"""
+    text_element(properties, 'guid', guid)
+    text_element(properties, 'name', name)
+    text_element(properties, 'description', 'Generated {}'.format(name.lower()))
+    text_element(properties, 'enabled', 'yes' if i % 7 else 'no')
+    text_element(properties, 'version', str(i % 5 + 1))
+    text_element(properties, 'versioncomment', 'Change {}'.format(i % 5))
+    folder = etree.SubElement(properties, 'folder')
+    text_element(folder, 'name', 'Generated')
+    subfolder = etree.SubElement(folder, 'folder')
+    text_element(subfolder, 'name', 'Folder {}'.format(i % 10))
+
+
+def resource_element(parent, guid, resourcetype, i, size=4096):
+    """Adds a resource of the given type, embedded ones with a script of about size bytes"""
+    resource = etree.SubElement(parent, 'resource')
+    properties = etree.SubElement(resource, 'properties')
+    text_element(properties, 'guid', guid)
+    text_element(properties, 'type', resourcetype)
+    text_element(properties, 'version', '1')
+    text_element(properties, 'versioncomment', '')
+    text_element(properties, 'enabled', 'yes')
+    text_element(properties, 'comment', 'Generated resource {}'.format(i))
+    folder = etree.SubElement(properties, 'folder')
+    text_element(folder, 'name', 'Resources')
+    if resourcetype == 'AMRESOURCEPACKAGE':
+        text_element(properties, 'name', 'Package{:04d}'.format(i))
+    else:
+        text_element(properties, 'file', 'resource{:04d}.ps1'.format(i))
+    if resourcetype == 'DATABASE':
+        text_element(properties, 'parsefilecontent', 'no')
+        text_element(properties, 'skipenvironmentvariables', 'yes')
+    elif resourcetype == 'FILESHARE':
+        text_element(properties, 'path', '\\\\fileserver\\packages\\resource{:04d}.ps1'.format(i))
+    elif resourcetype == 'URLRESOURCE':
+        text_element(properties, 'urlresource', 'https://packages.example.com/resource{:04d}.ps1'.format(i))
+    if resourcetype in ['DATABASE', 'AMRESOURCEPACKAGE']:
+        lines = script_lines['ps1']
+        payload = '\r\n'.join(lines[n % len(lines)] for n in range(size // 60 + 1)).encode('utf-8')[:size]
+        text_element(properties, 'crc32', '{:08X}'.format(zlib.crc32(payload)))
+        # bbreport.resource_payload_tag
+        text_element(resource, 'filedata', base64.encodebytes(payload).decode('ascii'))
+    return resource
+
+
+def parameter_element(parent, name, i, target=None):
+    """Adds a parameter, linked to a module or project parameter if target (type, guid) is given"""
+    param = etree.SubElement(parent, 'param')
+    text_element(param, 'name', name)
+    text_element(param, 'type', str(i % 6))
+    text_element(param, 'value1', 'Value {}'.format(i))
+    text_element(param, 'description', 'Generated parameter {}'.format(name))
+    inputtiming = etree.SubElement(param, 'inputtiming')
+    text_element(inputtiming, 'importbb', 'yes' if i % 2 else 'no', showprev='no')
+    text_element(inputtiming, 'schedulejob', 'no', showprev='yes', eraseprev='no')
+    selection = etree.SubElement(param, 'selection')
+    if target is not None:
+        attributes = {'type': target[0], 'guid': target[1]}
+        # Auto linked parameters go without a linktype
+        if i % 2 == 0:
+            attributes['linktype'] = str(i % 3)
+        link = etree.SubElement(selection, 'module', **attributes)
+        text_element(link, 'param', 'Parameter0')
+    return param
+
+
+def task_properties(task, tasktype, guid, enabled='yes'):
+    """Adds the properties every task has"""
+    properties = etree.SubElement(task, 'properties')
+    text_element(properties, 'type', tasktype)
+    text_element(properties, 'guid', guid)
+    text_element(properties, 'enabled', enabled)
+
+
+def task_element(parent, tasktype, guid, rng, script, resourceguids):
+    """Adds a task of the given type with settings as task_to_dict expects them"""
+    task = etree.SubElement(parent, 'task')
+    task_properties(task, tasktype, guid, 'yes' if rng.random() < 0.9 else 'no')
+    settings = etree.SubElement(task, 'settings')
+    if tasktype == 'PWRSHELL':
+        if rng.random() < 0.8:
+            text_element(settings, 'usescript', 'yes')
+            text_element(settings, 'source', script('ps1'))
+        else:
+            text_element(settings, 'usescript', 'no')
+            text_element(settings, 'resourcename', 'resource0000.ps1')
+            text_element(settings, 'resourceguid', resourceguids[0])
+    elif tasktype in ['COMMAND', 'LINUX_COMMAND']:
+        ext = 'cmd' if tasktype == 'COMMAND' else 'sh'
+        commandline = '@[SCRIPT]' if rng.random() < 0.7 else 'hostname'
+        text_element(settings, 'commandline', commandline)
+        text_element(settings, 'scriptext', ext)
+        for flag in ['usecmd', 'redirect', 'failonerroutput', 'validateexitcode', 'terminate', 'terminatetree']:
+            text_element(settings, flag, rng.choice(['yes', 'no']))
+        text_element(settings, 'timeout', str(rng.choice([5, 10, 30])))
+        text_element(settings, 'grablogfile', '%TEMP%\\install.log' if ext == 'cmd' else '/var/log/install.log')
+        text_element(settings, 'script', script(ext))
+    elif tasktype in ['DOWNLOAD', 'LINUX_DOWNLOAD']:
+        text_element(settings, 'ysnlog', 'yes')
+        text_element(settings, 'ysndestination', rng.choice(['yes', 'no']))
+        text_element(settings, 'destination', 'C:\\Packages')
+        count = rng.randint(1, min(3, len(resourceguids)))
+        text_element(settings, 'resources', ','.join(rng.sample(resourceguids, count)))
+    elif tasktype == 'SHUTDOWN':
+        for flag in ['message', 'reboot', 'force', 'check4users']:
+            text_element(settings, flag, rng.choice(['yes', 'no']))
+        text_element(settings, 'timeout', '5')
+        text_element(settings, 'messagetext', 'This computer will restart for maintenance')
+        text_element(settings, 'duration', '60')
+        text_element(settings, 'waitforreboot', 'yes')
+    elif tasktype == 'REGISTRY':
+        variant = rng.randrange(10)
+        registryfile = 'Windows Registry Editor Version 5.00\r\n\r\n'
+        for key in range(5):
+            registryfile += '[HKEY_LOCAL_MACHINE\\Software\\Contoso\\App{}\\Key{}]\r\n'.format(variant, key)
+            registryfile += '"Setting{}"="Value {}"\r\n"Count"=dword:{:08x}\r\n\r\n'.format(key, variant, key)
+        text_element(settings, 'regfile', reszlib(registryfile))
+    elif tasktype == 'FILEOPERATIONS':
+        fileoperationtasks = etree.SubElement(settings, 'fileoperationtasks')
+        for operation in ['copy', 'delete', 'rename']:
+            fileoperationtask = etree.SubElement(fileoperationtasks, 'fileoperationtask')
+            text_element(fileoperationtask, 'type', operation)
+            text_element(fileoperationtask, 'sourcelocation', 'C:\\Packages\\app.cfg')
+            text_element(fileoperationtask, 'destinationlocation', 'C:\\Program Files\\Contoso\\app.cfg')
+    elif tasktype == 'SECURITY':
+        text_element(settings, 'objecttype', str(rng.randint(1, 4)))
+        text_element(settings, 'filename', 'C:\\Program Files\\Contoso')
+        text_element(settings, 'replaceacl', 'no')
+        text_element(settings, 'propagate', 'yes')
+        permissions = etree.SubElement(settings, 'permissions')
+        for action, account, mask in [('1', 'CONTOSO\\Domain Users', '1179817'), ('2', 'CONTOSO\\Guests', '-1')]:
+            permission = etree.SubElement(permissions, 'permission')
+            text_element(permission, 'action', action)
+            text_element(permission, 'account', account)
+            text_element(permission, 'permission', mask)
+    return task
+
+
+def reszlib(text):
+    """Inverse of bbreport.unreszlib, a RESZLIB header followed by the hex encoded zlib stream"""
+    data = zlib.compress(text.encode('utf-8'))
+    return 'RESZLIB' + '{:015X}'.format(len(text)) + binascii.hexlify(data).decode('ascii').upper()
+
+
+def main():
+    """Main function, checks for arguments and writes the Building Block."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--file',
+                        default='./Export.xml',
+                        metavar='<BuildingBlock>',
+                        help='The Building Block XML File to write')
+
+    parser.add_argument('-m', '--modules',
+                        type=int,
+                        default=100,
+                        help='Number of modules (default 100)')
+
+    parser.add_argument('-t', '--tasks',
+                        type=int,
+                        default=10,
+                        help='Number of tasks per module (default 10)')
+
+    parser.add_argument('-p', '--projects',
+                        type=int,
+                        help='Number of projects (default a tenth of the modules)')
+
+    parser.add_argument('-r', '--resources',
+                        type=int,
+                        help='Number of resources (default a tenth of the modules)')
+
+    parser.add_argument('--script-lines',
+                        type=int,
+                        default=20,
+                        help='Number of lines per script (default 20)')
+
+    parser.add_argument('--unique-scripts',
+                        type=float,
+                        default=0.25,
+                        help='Fraction of scripts which are not shared with other tasks (default 0.25)')
+
+    parser.add_argument('--resource-size',
+                        type=int,
+                        default=4096,
+                        metavar='BYTES',
+                        help='Size of the file embedded in DATABASE and package resources (default 4096)')
+
+    parser.add_argument('--seed',
+                        type=int,
+                        default=1,
+                        help='Random seed, the same seed gives the same Building Block')
+    args = parser.parse_args()
+    tree = generate_buildingblock(args.modules, args.tasks, args.projects, args.resources,
+                                  args.script_lines, args.unique_scripts, args.resource_size, args.seed)
+    tree.write(args.file, encoding='utf-8', xml_declaration=True, pretty_print=True)
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    main()
@@ -3,20 +3,51 @@
 
 # import builtins
 import argparse
+import base64
 import binascii
+import bz2
+import collections
+import contextlib
+import cProfile
+import difflib
+import filecmp
+import glob
+import gzip
+import hashlib
+import heapq
+import http.server
+import io
+import json
+import lzma
+import mimetypes
+import multiprocessing
 import os
+import pickle
+import queue
+import re
 import shutil
+import sys
+import tarfile
+import threading
+import time
+import urllib.parse
+import zipfile
 import zlib
 
+# resource is only there on unix, the profile goes without peak memory elsewhere
+try:
+    import resource
+except ImportError:
+    resource = None
+
 # import 3rd party
 from lxml import etree
-from jinja2 import Environment, PackageLoader, select_autoescape
-env = Environment(
-    loader=PackageLoader('bbreport', 'templates'),
-    autoescape=select_autoescape(['html', 'xml']),
-    trim_blocks=True,
-    extensions=['jinja2_highlight.HighlightExtension']
-)
+
+# brotli is optional, only --brotli needs it
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # GPL
 """
@@ -71,6 +102,13 @@ task_displayname = {
     'LINUX_DOWNLOAD': "Download a resource (UNIX/Linux)"
 }
 
+reference_displayname = {
+    'module': "Project module",
+    'download': "Downloads resource",
+    'powershell': "Powershell resource file",
+    'parameter': "Linked parameter"
+}
+
 resourcetype_displayname = {
     'DATABASE': 'Stored in database',
     'FILESHARE': "Located on Fileshare",
@@ -128,466 +166,3009 @@ access_mask = {
 # Might want to refactor, but perhaps the structure of RES xml won't allow for that.
 bbtree = ''
 
+# Templates and images live next to this script
+basedir = os.path.dirname(os.path.abspath(__file__))
+
+# Matches the guids elements use to refer to each other, braces optional
+guid_pattern = re.compile(rb'\{?[0-9A-Fa-f]{8}-(?:[0-9A-Fa-f]{4}-){3}[0-9A-Fa-f]{12}\}?')
+
+# Script extensions from the export that may go into a file name, see cap_blob()
+extension_pattern = re.compile(r'\w{1,10}', re.ASCII)
+
+# Embedded resources (DATABASE, AMRESOURCEPACKAGE) carry their file base64 encoded in this child
+# of the resource element, next to the properties.
+resource_payload_tag = 'filedata'
+
+# Scripts, registry files and extracted resource files up to this size are shown inline by their
+# tasks. Larger ones get a file of their own and the page shows the start, see cap_blob().
+inline_limit = 256 * 1024
+blob_preview_lines = 50
+blob_preview_size = 16 * 1024
+
+# RESZLIB values expanding beyond this are not decoded, see unreszlib()
+reszlib_limit = 64 * 1024 * 1024
+
+# Output files which get compressed copies for static web servers, see --gzip and --brotli
+compressible_extensions = ('.html', '.css', '.js', '.json', '.txt')
+
+# Tar modes for --archive by extension, written as a stream without seeking back. Anything else is a zip file.
+tar_modes = {
+    '.tar': 'w|',
+    '.tar.gz': 'w|gz',
+    '.tgz': 'w|gz',
+    '.tar.bz2': 'w|bz2',
+    '.tar.xz': 'w|xz'
+}
+
+# Compressed exports by extension, with their first bytes and the function opening them by name or file
+# object, see open_buildingblock(). A zip file is opened with zipfile instead.
+input_formats = {
+    '.gz': (b'\x1f\x8b', gzip.open),
+    '.bz2': (b'BZh', bz2.open),
+    '.xz': (b'\xfd7zXZ\x00', lzma.open),
+    '.zip': (b'PK\x03\x04', None)
+}
+
+# What reading a truncated or corrupt compressed export ends in, besides IOError
+input_errors = (IOError, EOFError, lzma.LZMAError, zlib.error, zipfile.BadZipFile)
+
+# Where tasks keep their scripts and registry files, see task_script(). Registry files are hashed and
+# measured as stored, compressed if RESZLIB.
+script_settings = {
+    'PWRSHELL': 'settings/source',
+    'COMMAND': 'settings/script',
+    'LINUX_COMMAND': 'settings/script',
+    'REGISTRY': 'settings/regfile'
+}
+
+# Search terms are words of at least two characters, long ones are cut short. The search page
+# tokenizes queries the same way.
+search_term_pattern = re.compile(r'\w{2,}')
+search_term_length = 32
+search_stopwords = {'yes', 'no', 'none'}
+# Keys of page dictionaries holding guids, links and template plumbing rather than text
+search_skip_keys = {'guid', 'targetguid', 'resourceguid', 'template', 'lexer', 'link', 'payload', 'enabled',
+                    'usedby'}
+
+# Global guid lookup for all modules, projects and resources, see build_index().
+# Saves us from scanning the full tree with XPath for every cross reference.
+bbindex = {}
+
+# The tasks having each script of the index by its hash, see index_scripts()
+bbscripts = {}
+
+# Scripts written to scripts/ this run, identical ones of other modules are only written once
+scripts_written = set()
+
+
+class MissingReferenceError(LookupError):
+    """Raised when an element refers to a guid which is not in the Building Block"""
+    pass
+
+
+class OutputError(Exception):
+    """Raised by output_writer when an output file could not be written, with the error as its cause"""
+    pass
+
+
+class Schema(object):
+    """Declarative extraction of the fields of an element, every field an exact path below the element
+
+    Field paths are child tags separated by slashes, optionally ending in @attribute. They are compiled
+    once into a tree of tags which extract() walks in a single pass, visiting only the children on those
+    paths, where find('.//...') searches the whole subtree, scripts and registry files included. The
+    first child with a tag counts, as with find(). Lists are XPath expressions, compiled once as well."""
+    def __init__(self, fields, lists=None):
+        self.names = list(fields) + list(lists or {})
+        self.root = SchemaNode()
+        for name, path in fields.items():
+            node = self.root
+            steps = path.split('/')
+            attribute = steps.pop()[1:] if steps[-1].startswith('@') else None
+            for tag in steps:
+                node = node.children.setdefault(tag, SchemaNode())
+            if attribute is None:
+                node.text.append(name)
+            else:
+                node.attributes.setdefault(attribute, []).append(name)
+        self.lists = [(name, etree.XPath(path)) for name, path in (lists or {}).items()]
+
+    def extract(self, element):
+        """Returns a dictionary with the text or attribute of every field, None if it is not there, and the lists"""
+        values = dict.fromkeys(self.names)
+        self.visit(element, self.root, values)
+        for name, xpath in self.lists:
+            values[name] = xpath(element)
+        return values
+
+    @classmethod
+    def visit(cls, element, node, values):
+        for name in node.text:
+            values[name] = element.text
+        for attribute, names in node.attributes.items():
+            for name in names:
+                values[name] = element.get(attribute)
+        if node.children:
+            visited = set()
+            for child in element:
+                if child.tag in node.children and child.tag not in visited:
+                    visited.add(child.tag)
+                    cls.visit(child, node.children[child.tag], values)
+
+
+class SchemaNode(object):
+    """A tag in a compiled Schema, with the fields taken from it and the children to visit"""
+    __slots__ = ('text', 'attributes', 'children')
+
+    def __init__(self):
+        self.text = []
+        self.attributes = {}
+        self.children = {}
+
+
+class HighlightCache(object):
+    """Content addressed store for highlighted html, an in process LRU with an optional folder behind it
+
+    Entries are keyed by a hash of the lexer, formatter options and source. The folder survives between
+    runs and is trimmed to maxbytes by prune(), least recently used files first."""
+    def __init__(self, maxitems=1024):
+        self.maxitems = maxitems
+        self.memory = collections.OrderedDict()
+        self.folder = None
+        self.maxbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def open(self, folder, maxbytes):
+        """Keeps entries in folder as well, up to maxbytes in total"""
+        self.folder = folder
+        self.maxbytes = maxbytes
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.folder, key[:2], key + '.html')
+
+    def get(self, key):
+        """Returns the cached html for key or None, counting the hit or miss"""
+        html = self.memory.get(key)
+        if html is not None:
+            self.memory.move_to_end(key)
+        elif self.folder is not None:
+            try:
+                with open(self.filename(key), 'rt', encoding='utf-8') as file:
+                    html = file.read()
+                # Touch it, prune() goes by modification time
+                os.utime(self.filename(key))
+                self.remember(key, html)
+            except IOError:
+                pass
+        if html is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return html
+
+    def put(self, key, html):
+        self.remember(key, html)
+        if self.folder is not None:
+            filename = self.filename(key)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            # Write and rename, parallel workers may be storing the same entry
+            temporary = '{}.{}.tmp'.format(filename, os.getpid())
+            with open(temporary, 'wt', encoding='utf-8') as file:
+                file.write(html)
+            os.replace(temporary, filename)
+
+    def remember(self, key, html):
+        self.memory[key] = html
+        if len(self.memory) > self.maxitems:
+            self.memory.popitem(last=False)
+
+    def prune(self):
+        """Removes the least recently used files until the folder is within maxbytes"""
+        if self.folder is None:
+            return
+        entries = []
+        for path, folders, files in os.walk(self.folder):
+            for name in files:
+                stat = os.stat(os.path.join(path, name))
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(path, name)))
+        total = sum(entry[1] for entry in entries)
+        for mtime, size, filename in sorted(entries):
+            if total <= self.maxbytes:
+                break
+            os.remove(filename)
+            total -= size
+
+
+class PageCache(object):
+    """In process LRU of rendered pages for --serve, bounded by the total size of the pages in bytes"""
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.pages = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        """Returns the cached page for path or None, counting the hit or miss"""
+        page = self.pages.get(path)
+        if page is None:
+            self.misses += 1
+        else:
+            self.pages.move_to_end(path)
+            self.hits += 1
+        return page
+
+    def put(self, path, page):
+        if path in self.pages:
+            self.size -= len(self.pages.pop(path))
+        self.pages[path] = page
+        self.size += len(page)
+        while self.size > self.maxbytes and self.pages:
+            self.size -= len(self.pages.popitem(last=False)[1])
+
+    def clear(self):
+        self.pages.clear()
+        self.size = 0
+
+
+class ReportServer(http.server.HTTPServer):
+    """Serves the report of one Building Block, rendering every page when it is first asked for
+
+    The export is parsed once into bbtree and bbindex, and again whenever its modification time or
+    size changes. Rendered pages are kept in a PageCache of cache_size bytes."""
+    def __init__(self, address, bb, cache_size):
+        self.bb = bb
+        self.cache = PageCache(cache_size)
+        self.static = {'/' + name: source for source, name in static_files()}
+        self.stamp = None
+        self.reload()
+        super(ReportServer, self).__init__(address, ReportRequestHandler)
+
+    def reload(self):
+        """Parses the Building Block again if it changed on disk since the last time"""
+        stat = os.stat(self.bb)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp == self.stamp:
+            return
+        global bbtree, bbindex, bbscripts
+        start = time.perf_counter()
+        with open_buildingblock(self.bb) as buildingblock:
+            tree = etree.parse(buildingblock, etree.XMLParser(huge_tree=True))
+        # Only replace what we have once the new export parsed, it may still be being written
+        bbtree = tree
+        bbindex = build_index(bbtree)
+        bbscripts = index_scripts(bbindex)
+        self.stamp = stamp
+        self.cache.clear()
+        print("Loaded {} in {:.2f}s".format(self.bb, time.perf_counter() - start))
+
+    def page(self, path):
+        """Returns the html for a path of the report, or None if there is no such page"""
+        if path in ['/', '/index.html']:
+            template = environment().get_template('index.html')
+            return template.render(index=index_dict(self.bb), search=False, shared=any(
+                len(uses) > 1 for uses in bbscripts.values()))
+        if path == '/shared.html':
+            return environment().get_template('shared.html').render(shared=shared_scripts())
+        match = re.match(r'^/scripts/([0-9a-f]{40})\.html$', path)
+        if match is not None:
+            blob = self.script(match.group(1), path)
+            return None if blob is None else render_page('script', blob)
+        match = re.match(r'^/(resource|module|project)s/(\{[0-9A-Fa-f-]+\})\.html$', path)
+        if match is None:
+            return None
+        kind, guid = match.groups()
+        entry = bbindex.get(guid)
+        if entry is None or entry['kind'] != kind:
+            return None
+        return render_page(kind, page_model(kind, entry['element']))
+
+    def blob(self, path):
+        """Returns the text of a script or registry file too large for its module page, see cap_blob()"""
+        match = re.match(r'^/scripts/([0-9a-f]{40})\.\w+\.txt$', path)
+        if match is None:
+            return None
+        blob = self.script(match.group(1), path)
+        return None if blob is None else blob['text']
+
+    def script(self, digest, path):
+        """Returns the blob of a task having the script with this hash which links to path, or None"""
+        name = path.rsplit('/', 1)[-1]
+        for guid in sorted(set(guid for guid, tasktype, size in bbscripts.get(digest, ()))):
+            for task in page_model('module', bbindex[guid]['element']).tasks:
+                if task.blob and task.blob['link'] == name:
+                    return task.blob
+        return None
+
+
+class ReportRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Answers the GET requests of a ReportServer with pages from its cache, rendering those it misses"""
+    def do_GET(self):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        try:
+            self.server.reload()
+        except input_errors + (etree.XMLSyntaxError,) as err:
+            self.send_error(503, "Could not load {}".format(self.server.bb), str(err))
+            return
+        if path in self.server.static:
+            with open(self.server.static[path], 'rb') as file:
+                self.send_body(file.read(), mimetypes.guess_type(path)[0] or 'application/octet-stream')
+            return
+        try:
+            text = self.server.blob(path)
+        except MissingReferenceError:
+            text = None
+        if text is not None:
+            self.send_body(text.encode('utf-8'), 'text/plain; charset=utf-8')
+            return
+        body = self.server.cache.get(path)
+        if body is None:
+            try:
+                html = self.server.page(path)
+            except MissingReferenceError as err:
+                self.send_error(500, "Error processing {}".format(self.server.bb), str(err))
+                return
+            if html is None:
+                self.send_error(404)
+                return
+            body = html.encode('utf-8')
+            self.server.cache.put(path, body)
+        self.send_body(body, 'text/html; charset=utf-8')
+
+    def send_body(self, body, contenttype):
+        self.send_response(200)
+        self.send_header('Content-Type', contenttype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def highlight_extension():
+    """Returns CachedHighlightExtension, a HighlightExtension which asks highlight_cache before running Pygments
+
+    jinja2_highlight brings jinja2 and Pygments along, so it is only imported once environment() needs it."""
+    from jinja2_highlight import HighlightExtension
+
+    class CachedHighlightExtension(HighlightExtension):
+        def _highlight(self, lang, linenos, caller=None):
+            body = caller()
+            cssclass = getattr(self.environment, 'jinja2_highlight_cssclass', None)
+            key = highlight_cache.key(lang, linenos, cssclass, body)
+            html = highlight_cache.get(key)
+            if html is None:
+                with profiler.stage('render/jinja/highlight'):
+                    html = super(CachedHighlightExtension, self)._highlight(lang, linenos, caller=lambda: body)
+                highlight_cache.put(key, html)
+            return html
+
+    # Compiled templates refer to the extension by its identifier, which jinja2 sets from the module name.
+    # That differs between running as a script, an import and a spawned worker, sharing the bytecode cache.
+    CachedHighlightExtension.identifier = 'bbreport.CachedHighlightExtension'
+    return CachedHighlightExtension
+
+
+class OutputWriter(object):
+    """Writes the output files from a pool of threads fed through a bounded queue, while rendering goes on
+
+    Used as a context manager around a run, which starts the threads and waits for them at the end.
+    write() blocks while the queue is full, so rendering never gets far ahead of a slow filesystem.
+    The first error of a writer thread is raised again by the next write() or at the end of the run,
+    as OutputError so it is not taken for an error reading the input.
+    Without threads, or outside a run, files are written right away. Counts the files and bytes.
+
+    With an archive opened the files go into that instead of the output folder, see open_archive().
+    With suffixes set every compressible file gets compressed copies next to it, see compressors. The
+    writer threads compress in parallel, only adding to the archive is one at a time."""
+    def __init__(self, threads=4):
+        self.threads = threads
+        self.workers = []
+        self.queue = None
+        self.error = None
+        self.lock = threading.Lock()
+        self.suffixes = []
+        self.archive = None
+        self.archive_root = None
+        self.archive_lock = threading.Lock()
+        self.files = 0
+        self.bytes = 0
+        self.compressed = 0
+        self.compressed_bytes = 0
+        self.compress_time = 0.0
+
+    def __enter__(self):
+        self.error = None
+        if self.threads > 0:
+            self.queue = queue.Queue(self.threads * 16)
+            self.workers = [threading.Thread(target=self.run, daemon=True) for i in range(self.threads)]
+            for worker in self.workers:
+                worker.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.queue is not None:
+            for worker in self.workers:
+                self.queue.put(None)
+            for worker in self.workers:
+                worker.join()
+            self.queue = None
+            self.workers = []
+        error, self.error = self.error, None
+        # An exception on its way out already says what went wrong
+        if error is not None and exc_type is None:
+            raise error
+
+    def open_archive(self, filename, root):
+        """Writes everything under the root folder to a zip or tar file from now on, named relative to root
+
+        A .tar, .tar.gz, .tgz, .tar.bz2 or .tar.xz file is written as a stream, anything else is a zip file."""
+        for extension, mode in tar_modes.items():
+            if filename.endswith(extension):
+                self.archive = tarfile.open(filename, mode)
+                break
+        else:
+            self.archive = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED)
+        self.archive_root = root
+
+    def close_archive(self):
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+
+    def run(self):
+        """Writer thread, runs the queued jobs until it gets None. After an error the rest is skipped."""
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                job[0](*job[1:])
+            except Exception as err:
+                self.error = output_error(err)
+
+    def submit(self, function, *arguments):
+        if self.error is not None:
+            raise self.error
+        if self.queue is None:
+            try:
+                function(*arguments)
+            except Exception as err:
+                raise output_error(err) from err
+        else:
+            self.queue.put((function,) + arguments)
+
+    def write(self, filename, text):
+        """Writes text to filename in utf-8, creating its folder if needed"""
+        self.submit(self.write_file, filename, text)
+
+    def copy(self, source, destination):
+        """Copies source to destination, unless that is already identical"""
+        self.submit(self.copy_file, source, destination)
+
+    def link(self, source, destination):
+        """Hard links destination and its compressed copies to source and its copies, written before"""
+        self.submit(self.link_file, source, destination)
+
+    def clear(self, folder):
+        """Empties folder for a new report. An archive starts out empty anyway."""
+        if self.archive is None:
+            shutil.rmtree(folder, ignore_errors=True)
+            os.makedirs(folder)
+
+    def write_file(self, filename, text):
+        self.store(filename, text.encode('utf-8'))
+
+    def copy_file(self, source, destination):
+        if self.archive is None and self.up_to_date(source, destination):
+            return
+        with open(source, 'rb') as file:
+            self.store(destination, file.read())
+
+    def link_file(self, source, destination):
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        pairs = [(source, destination)] + [(source + suffix, destination + suffix) for suffix in self.suffixes
+                                           if destination.endswith(compressible_extensions)]
+        for original, name in pairs:
+            if os.path.exists(name):
+                if os.path.samefile(original, name):
+                    continue
+                os.remove(name)
+            try:
+                os.link(original, name)
+            except OSError:
+                # Another filesystem, or one without hard links
+                shutil.copyfile(original, name)
+            self.count(os.path.getsize(name))
+
+    def up_to_date(self, source, destination):
+        """Returns True if destination is identical to source and has its compressed copies"""
+        return (os.path.exists(destination) and filecmp.cmp(source, destination, shallow=False) and
+                all(os.path.exists(name) for name, compress in self.compressed_copies(destination)))
+
+    def compressed_copies(self, filename):
+        """Returns (filename, compress function) for the compressed copies filename should get"""
+        if not filename.endswith(compressible_extensions):
+            return []
+        return [(filename + suffix, compressors[suffix]) for suffix in self.suffixes]
+
+    def store(self, filename, data):
+        """Writes data and its compressed copies to filename or the archive"""
+        self.put(filename, data)
+        for name, compress in self.compressed_copies(filename):
+            # CPU time of this thread, the others compressing alongside don't count
+            start = time.thread_time()
+            copy = compress(data)
+            with self.lock:
+                self.compressed += 1
+                self.compressed_bytes += len(copy)
+                self.compress_time += time.thread_time() - start
+            self.put(name, copy)
+
+    def put(self, filename, data):
+        if self.archive is None:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, 'wb') as file:
+                file.write(data)
+        else:
+            name = os.path.relpath(filename, self.archive_root).replace(os.sep, '/')
+            with self.archive_lock:
+                if isinstance(self.archive, zipfile.ZipFile):
+                    self.archive.writestr(name, data)
+                else:
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    info.mtime = int(time.time())
+                    self.archive.addfile(info, io.BytesIO(data))
+        self.count(len(data))
+
+    def count(self, size):
+        with self.lock:
+            self.files += 1
+            self.bytes += size
+
+    def collect(self):
+        """Returns the files and bytes written so far and starts over, workers hand them to merge() this way"""
+        with self.lock:
+            counts = (self.files, self.bytes, self.compressed, self.compressed_bytes, self.compress_time)
+            self.files, self.bytes = 0, 0
+            self.compressed, self.compressed_bytes, self.compress_time = 0, 0, 0.0
+        return counts
+
+    def merge(self, counts):
+        with self.lock:
+            self.files += counts[0]
+            self.bytes += counts[1]
+            self.compressed += counts[2]
+            self.compressed_bytes += counts[3]
+            self.compress_time += counts[4]
+
+    def summary(self, wall):
+        """Returns a line with the files and bytes written, in total and per second of wall time, and one
+        with the compressed copies and the CPU time spent on them by all threads together"""
+        wall = max(wall, 1e-6)
+        summary = "Wrote {} files, {:.1f} MB in {:.2f}s, {:.0f} files/s, {:.1f} MB/s".format(
+            self.files, self.bytes / 1048576, wall, self.files / wall, self.bytes / 1048576 / wall)
+        if self.compressed:
+            summary += "\nCompressed {} copies to {:.1f} MB in {:.2f}s CPU".format(
+                self.compressed, self.compressed_bytes / 1048576, self.compress_time)
+        return summary
+
+
+def output_error(err):
+    """Returns an OutputError for an error of output_writer, keeping it as the cause"""
+    error = OutputError(str(err))
+    error.__cause__ = err
+    return error
+
+
+class Profiler(object):
+    """Collects wall and CPU time per stage, time per task type and the slowest pages, see --profile
+
+    Stage names are paths, 'render/jinja' is part of 'render'. Nothing is recorded unless enabled."""
+    def __init__(self, slowest=10):
+        self.enabled = False
+        self.slowest = slowest
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.tasks = {}
+        self.pages = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+    def add_stage(self, name, wall, cpu, count=1):
+        totals = self.stages.setdefault(name, [0.0, 0.0, 0])
+        totals[0] += wall
+        totals[1] += cpu
+        totals[2] += count
+
+    def add_task(self, tasktype, wall, count=1):
+        totals = self.tasks.setdefault(tasktype, [0.0, 0])
+        totals[0] += wall
+        totals[1] += count
+
+    def add_page(self, wall, kind, guid):
+        # Min heap of the slowest pages, the fastest of them drops off first
+        heapq.heappush(self.pages, (wall, kind, guid))
+        if len(self.pages) > self.slowest:
+            heapq.heappop(self.pages)
+
+    def collect(self):
+        """Returns everything recorded so far and starts over, workers hand their share to merge() this way"""
+        data = (self.stages, self.tasks, self.pages)
+        self.reset()
+        return data
+
+    def merge(self, data):
+        stages, tasks, pages = data
+        for name, totals in stages.items():
+            self.add_stage(name, *totals)
+        for tasktype, totals in tasks.items():
+            self.add_task(tasktype, *totals)
+        for page in pages:
+            self.add_page(*page)
+
+    def report(self):
+        """Returns the profile as a dictionary, ready for json"""
+        return {
+            'stages': [{'name': name, 'wall': totals[0], 'cpu': totals[1], 'count': totals[2]}
+                       for name, totals in sorted(self.stages.items())],
+            'tasks': [{'type': tasktype, 'wall': totals[0], 'count': totals[1]}
+                      for tasktype, totals in sorted(self.tasks.items(), key=lambda k: -k[1][0])],
+            'slowest_pages': [{'wall': wall, 'kind': kind, 'guid': guid}
+                              for wall, kind, guid in sorted(self.pages, reverse=True)],
+            'peak_rss_kb': peak_rss()
+        }
+
+    def summary(self):
+        """Returns the profile as human readable text"""
+        report = self.report()
+        lines = ['{:<32}{:>10}{:>10}{:>10}'.format('Stage', 'Wall (s)', 'CPU (s)', 'Count')]
+        for stage in report['stages']:
+            # Nested stages are indented below the one they are part of
+            name = '  ' * stage['name'].count('/') + stage['name'].split('/')[-1]
+            lines.append('{:<32}{:>10.3f}{:>10.3f}{:>10}'.format(name, stage['wall'], stage['cpu'], stage['count']))
+        lines.append('')
+        lines.append('{:<32}{:>10}{:>10}'.format('Task type', 'Wall (s)', 'Count'))
+        for task in report['tasks']:
+            lines.append('{:<32}{:>10.3f}{:>10}'.format(task['type'], task['wall'], task['count']))
+        lines.append('')
+        lines.append('Slowest pages')
+        for page in report['slowest_pages']:
+            lines.append('{:>10.3f}  {}s/{}.html'.format(page['wall'], page['kind'], page['guid']))
+        if report['peak_rss_kb'] is not None:
+            lines.append('')
+            lines.append('Peak RSS: {:.1f} MB'.format(report['peak_rss_kb'] / 1024))
+        return '\n'.join(lines)
+
+
+def peak_rss():
+    """Returns the peak resident set size in KB of this process or its largest worker, None if unknown"""
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Linux reports KB, macOS bytes
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+class ResourceExtractor(object):
+    """lxml parser target writing the embedded file of every resource to resources/<guid>/ as it streams by
+
+    Only the properties of the current resource are kept. The payload goes through base64 decoding,
+    the CRC32 and into the file one chunk at a time, it is never in memory as a whole. The result is
+    a dictionary of the extracted files keyed by resource guid, see extract_resources()."""
+    def __init__(self, output_folder):
+        self.output_folder = output_folder
+        self.path = []
+        self.text = []
+        self.properties = {}
+        self.payload = None
+        self.extracted = {}
+        # Resources come first in a Building Block, so we can stop reading once they are done
+        self.done = False
+
+    def start(self, tag, attrib):
+        self.path.append(tag)
+        self.text = []
+        if self.path[-3:] == ['resources', 'resource', resource_payload_tag]:
+            # The properties might come after the payload, so it goes to a temporary file first
+            os.makedirs(self.output_folder + '/resources', exist_ok=True)
+            self.payload = open(self.output_folder + '/resources/payload.tmp', 'wb')
+            self.remainder = ''
+            self.crc32 = 0
+            self.size = 0
+
+    def data(self, data):
+        if self.payload is not None:
+            # base64 decodes in blocks of 4 characters, keep the rest for the next chunk
+            encoded = self.remainder + ''.join(data.split())
+            cut = len(encoded) - len(encoded) % 4
+            self.remainder = encoded[cut:]
+            self.write(base64.b64decode(encoded[:cut]))
+        elif self.path[-4:-1] == ['resources', 'resource', 'properties']:
+            self.text.append(data)
+
+    def write(self, chunk):
+        self.payload.write(chunk)
+        self.crc32 = zlib.crc32(chunk, self.crc32)
+        self.size += len(chunk)
+
+    def end(self, tag):
+        if self.payload is not None and tag == resource_payload_tag:
+            self.write(base64.b64decode(self.remainder))
+            self.payload.close()
+            self.payload = None
+            self.properties[resource_payload_tag] = (self.crc32, self.size)
+        elif self.path[-4:-1] == ['resources', 'resource', 'properties']:
+            self.properties[tag] = ''.join(self.text)
+        elif self.path[-2:] == ['resources', 'resource']:
+            self.finish_resource()
+        elif self.path[-2:] == ['buildingblock', 'resources']:
+            self.done = True
+        self.path.pop()
+
+    def finish_resource(self):
+        properties, self.properties = self.properties, {}
+        if resource_payload_tag not in properties:
+            return
+        crc32, size = properties[resource_payload_tag]
+        guid = properties.get('guid')
+        if not valid_guid(guid):
+            print("Skipping the file of resource {!r}, its guid is not a guid".format(guid))
+            os.remove(self.output_folder + '/resources/payload.tmp')
+            return
+        name = properties.get('name') if properties.get('type') == 'AMRESOURCEPACKAGE' else properties.get('file')
+        # Never trust a file name from the Building Block with a path, or one that is a folder
+        name = os.path.basename((name or '').replace('\\', '/'))
+        if name in ['', '.', '..']:
+            name = 'payload'
+        folder = self.output_folder + '/resources/' + guid
+        os.makedirs(folder, exist_ok=True)
+        os.replace(self.output_folder + '/resources/payload.tmp', folder + '/' + name)
+        stored = properties.get('crc32')
+        self.extracted[guid] = {
+            'path': os.path.abspath(folder + '/' + name),
+            'link': 'resources/' + guid + '/' + name,
+            'size': size,
+            'crc32': '{:08X}'.format(crc32),
+            'verified': None if not stored else crc32_matches(stored, crc32)
+        }
+        if stored and not self.extracted[guid]['verified']:
+            print("CRC32 mismatch for resource {} {}: stored {}, extracted {:08X}".format(
+                name, guid, stored, crc32))
+
+    def close(self):
+        return self.extracted
+
 
-def process_buildingblock(bb, output_folder):
-    """Open Building Block file, parse as xml and dispatch the sections to their respective parser functions"""
+class PayloadCounter(object):
+    """lxml parser target building the tree like etree.TreeBuilder, but only counting the embedded files
+
+    The payload of a resource goes by chunk by chunk, its decoded size is worked out from the number of
+    base64 characters and the padding at the end. The payload element itself stays empty. Completed
+    resources, modules and projects are collected in elements as (kind, element, payload size)."""
+    def __init__(self):
+        self.builder = etree.TreeBuilder()
+        self.path = []
+        self.elements = []
+        self.payload = None
+        self.length = None
+        self.tail = ''
+
+    def start(self, tag, attrib):
+        self.path.append(tag)
+        self.builder.start(tag, attrib)
+        # Called for every element, so the tag goes first
+        if tag == 'resource' and self.path[-2:-1] == ['resources']:
+            self.payload = None
+        elif tag == resource_payload_tag and self.path[-3:-1] == ['resources', 'resource']:
+            self.length = 0
+            self.tail = ''
+
+    def data(self, data):
+        if self.length is None:
+            self.builder.data(data)
+            return
+        data = ''.join(data.split())
+        self.length += len(data)
+        self.tail = (self.tail + data)[-2:]
+
+    def end(self, tag):
+        element = self.builder.end(tag)
+        if tag in ('resource', 'module', 'project') and self.path[-3:-1] == ['buildingblock', tag + 's']:
+            self.elements.append((tag, element, self.payload if tag == 'resource' else None))
+        elif tag == resource_payload_tag and self.length is not None:
+            self.payload = self.length * 3 // 4 - self.tail.count('=')
+            self.length = None
+        self.path.pop()
+
+    def close(self):
+        return self.builder.close()
+
+
+class Model(object):
+    """Base of the slotted classes of the Building Block model, filled from the *_to_dict dictionaries
+
+    Templates find the fields as attributes, just like they found the dictionary keys. Fields the
+    dictionary does not have are None. The model holds no xml, cross references are resolved."""
+    __slots__ = ()
+
+    def __init__(self, fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    def to_dict(self):
+        """Returns the fields as a dictionary again, those of nested model objects included"""
+        fields = {}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if isinstance(value, list):
+                value = [item.to_dict() if isinstance(item, Model) else item for item in value]
+            fields[name] = value
+        return fields
+
+
+class Parameter(Model):
+    __slots__ = ('name', 'type', 'value', 'description', 'input', 'links')
+
+
+class Task(Model):
+    __slots__ = ('type', 'displayname', 'guid', 'enabled', 'settings', 'template', 'blob')
+
+
+class Resource(Model):
+    __slots__ = ('guid', 'name', 'displayname', 'version', 'versioncomment', 'type', 'folderpath', 'enabled',
+                 'comment', 'parsefilecontent', 'skipenvironmentvariables', 'crc32', 'path', 'urlresource',
+                 'payload', 'usedby')
+
+
+class Module(Model):
+    __slots__ = ('title', 'guid', 'enabled', 'description', 'version', 'versioncomment', 'folderpath',
+                 'parameters', 'tasks', 'usedby')
+
+    def __init__(self, fields):
+        super(Module, self).__init__(fields)
+        self.parameters = [Parameter(parameter) for parameter in self.parameters]
+        self.tasks = [Task(task) for task in self.tasks]
+
+
+class Project(Model):
+    __slots__ = ('title', 'guid', 'enabled', 'description', 'version', 'versioncomment', 'folderpath',
+                 'parameters', 'modules', 'usedby')
+
+    def __init__(self, fields):
+        super(Project, self).__init__(fields)
+        self.parameters = [Parameter(parameter) for parameter in self.parameters]
+
+
+class ModelCache(object):
+    """Folder of pickled Building Block models, so a re-run on an unchanged export skips the parse
+
+    A model is stored by the path of its export and used while the export has the same size and
+    modification time, or failing that the same sha1, as when it was stored. Any change to this
+    script makes all of them stale, template changes don't."""
+    def __init__(self):
+        self.folder = None
+
+    def open(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def filename(self, bb):
+        return os.path.join(self.folder, hashlib.sha1(os.path.abspath(bb).encode('utf-8')).hexdigest() + '.model')
+
+    def load(self, bb):
+        """Returns the stored model of bb if it is still current, None otherwise"""
+        try:
+            with open(self.filename(bb), 'rb') as file:
+                # The stamp goes first, the model itself is only unpickled if it matches
+                stamp = pickle.load(file)
+                if stamp['fingerprint'] != model_fingerprint():
+                    return None
+                stat = os.stat(bb)
+                if (stat.st_size, stat.st_mtime_ns) == (stamp['size'], stamp['mtime']):
+                    return pickle.load(file)
+                if stat.st_size != stamp['size'] or file_sha1(bb) != stamp['sha1']:
+                    return None
+                model = pickle.load(file)
+        except (IOError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            return None
+        # Same content with a new modification time, a copy or a touch. Don't hash it again next time.
+        self.store(bb, model)
+        return model
+
+    def store(self, bb, model):
+        stat = os.stat(bb)
+        stamp = {
+            'fingerprint': model_fingerprint(),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'sha1': file_sha1(bb)
+        }
+        filename = self.filename(bb)
+        # Write and rename, batch workers may be storing at the same time
+        temporary = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(temporary, 'wb') as file:
+            pickle.dump(stamp, file, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(model, file, pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, filename)
+
+
+def model_fingerprint():
+    """Returns a hash of the version, this script and the inline limit, models stored otherwise are stale"""
+    digest = hashlib.sha1('{}|{}'.format(__version__, inline_limit).encode('utf-8'))
+    with open(os.path.abspath(__file__), 'rb') as file:
+        digest.update(file.read())
+    return digest.hexdigest()
+
+
+def file_sha1(filename):
+    """Returns the sha1 of a file, read in blocks"""
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class SearchIndex(object):
+    """Inverted index over the text of every page, written as shards the search page loads on demand
+
+    Terms are lower case words of two or more characters, shards hold all terms sharing their first
+    two characters. Pages are kept by guid so an incremental run can replace just the changed ones."""
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.pages = {}
+
+    def add(self, kind, page):
+        title = page.name if kind == 'resource' else page.title
+        self.pages[page.guid] = [kind + 's/' + page.guid + '.html', title, kind, sorted(page_terms(page))]
+
+    def collect(self):
+        """Returns the pages added so far and starts over, workers hand them to merge() this way"""
+        pages = self.pages
+        self.reset()
+        return pages
+
+    def merge(self, pages):
+        self.pages.update(pages)
+
+    def load(self, output_folder):
+        """Picks up the pages of the previous run, for an incremental run"""
+        try:
+            with open(output_folder + '/search/pages.json', 'rt', encoding='utf-8') as file:
+                self.pages = json.load(file)
+        except (IOError, ValueError):
+            self.pages = {}
+
+    def retain(self, guids):
+        """Drops the pages of elements which are no longer there"""
+        self.pages = {guid: page for guid, page in self.pages.items() if guid in guids}
+
+    def write(self, output_folder):
+        """Writes the document list and the shards as scripts, so search works from file:// as well"""
+        folder = output_folder + '/search'
+        output_writer.clear(folder)
+        # Document ids follow the titles, the postings come out sorted and search results in order
+        pages = sorted(self.pages.items(), key=lambda k: (k[1][1] or '', k[0]))
+        shards = {}
+        for docid, (guid, page) in enumerate(pages):
+            for term in page[3]:
+                shards.setdefault(shard_key(term), {}).setdefault(term, []).append(docid)
+        for key, shard in shards.items():
+            write_script(folder + '/shard-' + key + '.js', 'bbsearch.shardLoaded', key, shard)
+        documents = [page[:3] for guid, page in pages]
+        write_script(folder + '/documents.js', 'bbsearch.documentsLoaded', documents)
+        output_writer.write(folder + '/pages.json', json.dumps(self.pages, separators=(',', ':')))
+
+
+def page_terms(page):
+    """Returns the search terms in all text of a page, nested tasks and parameters included"""
+    terms = set()
+    stack = [page]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, Model):
+            stack.extend(getattr(value, name) for name in value.__slots__ if name not in search_skip_keys)
+        elif isinstance(value, dict):
+            stack.extend(item for key, item in value.items() if key not in search_skip_keys)
+        elif isinstance(value, list):
+            stack.extend(value)
+        elif isinstance(value, str):
+            terms.update(term[:search_term_length] for term in search_term_pattern.findall(value.lower()))
+    return terms - search_stopwords
+
+
+def shard_key(term):
+    """Returns the shard a term goes in, its first two characters or their hex code if not plain ascii"""
+    key = term[:2]
+    if re.match('^[a-z0-9_]{2}$', key):
+        return key
+    return 'x' + binascii.hexlify(key.encode('utf-8')).decode('ascii')
+
+
+def write_script(filename, function, *arguments):
+    """Writes a script calling function with the arguments as json"""
+    script = ','.join(json.dumps(argument, separators=(',', ':')) for argument in arguments)
+    output_writer.write(filename, function + '(' + script + ');\n')
+
+
+def gzip_compress(data):
+    """Returns data gzipped without a timestamp, so an unchanged file gets an unchanged copy"""
+    return gzip.compress(data, 9, mtime=0)
+
+
+def brotli_compress(data):
+    """Returns data compressed with brotli. The top quality saves another tenth at seven times the time."""
+    return brotli.compress(data, mode=brotli.MODE_TEXT, quality=9)
+
+
+# The compressed copies written next to the output files by suffix, see --gzip and --brotli
+compressors = {
+    '.gz': gzip_compress,
+    '.br': brotli_compress
+}
+
+
+# Many modules share the same scripts, no need to highlight them more than once
+highlight_cache = HighlightCache()
+
+# Switched on by --profile, otherwise the stage timers are a no-op
+profiler = Profiler()
+
+# Filled by write_page() unless --no-search, written by process_buildingblock()
+search_index = SearchIndex()
+
+# Parsed models of the exports, only used if a folder is given
+model_cache = ModelCache()
+
+# Every page and other output file goes through here, see --writers
+output_writer = OutputWriter()
+
+# Set up by environment() on first use, --stats and --list never need it
+env = None
+
+
+def environment():
+    """Returns the jinja2 environment of the templates, importing jinja2 and setting it up the first time
+
+    Templates don't change during a run, so skip the up to date checks and keep the compiled
+    templates in the bytecode cache to save parsing them again next run."""
+    global env
+    if env is None:
+        from jinja2 import Environment, FileSystemBytecodeCache, PackageLoader, select_autoescape
+        env = Environment(
+            loader=PackageLoader('bbreport', 'templates'),
+            autoescape=select_autoescape(['html', 'xml']),
+            trim_blocks=True,
+            auto_reload=False,
+            # Not jinja2's default name, those may refer to the extension by another identifier
+            bytecode_cache=FileSystemBytecodeCache(pattern='__bbreport_%s.cache'),
+            extensions=[highlight_extension()]
+        )
+    return env
+
+
+def process_buildingblock(bb, output_folder, stream=False, jobs=1, incremental=False, extract=False, ndjson=False,
+                          render=True, static=None):
+    """Open Building Block file, parse as xml and dispatch the sections to their respective parser functions
+
+    With stream set the file is read twice with iterparse instead of being loaded as a whole. The first
+    pass only collects the guid index, the second renders every element as soon as it is complete.
+    With jobs > 1 the pages are rendered by a pool of that many processes, see render_pages().
+    With incremental set the output folder is kept and only pages whose inputs changed since the
+    previous incremental run are written, see changed_elements().
+    With extract set the embedded resource files are written to resources/<guid>/, see ResourceExtractor.
+    With a model cache folder opened the parse is skipped for an export seen before, see ModelCache.
+    With ndjson set every element is written to model.ndjson as it comes along, see export_elements().
+    With render unset there are no pages, search or index, just graph.json and the ndjson if set.
+    The file may be compressed or '-' for stdin, see open_buildingblock(). Stdin can't be streamed or extracted.
+    With static set the stylesheets and images are hard links to those in that folder, see copy_static().
+    All files are written by output_writer, rendering goes on while it catches up, into an archive if opened.
+    Returns the index of the Building Block, or None if it could not be processed."""
     try:
-        with open(bb) as buildingblock:
+        with open_buildingblock(bb) as buildingblock, output_writer, contextlib.ExitStack() as stack:
             print("Processing {}".format(bb))
-            # clear output directory
-            shutil.rmtree(output_folder)
-            os.makedirs(output_folder)
-            shutil.copyfile('./templates/bbreport.css', './output/bbreport.css')
-            shutil.copyfile('./templates/vs.css', './output/vs.css')
-            shutil.copytree('./img/', './output/img/')
-            global bbtree
-            bbtree = (etree.parse(buildingblock))
-
-            # Create a page for every resource
-            resourceroot = bbtree.find("/buildingblock/resources")
-            if len(resourceroot) > 0:
-                os.makedirs(output_folder + '/resources')
-                for resource in resourceroot.getchildren():
-                    html, guid = create_resource_page(resource)
-                    filename = output_folder + "/resources/" + guid + ".html"
-                    with open(filename, 'wt', encoding='utf-8') as file:
-                        file.write(html)
-
-            # First item of business is creating all module pages
-            moduleroot = bbtree.find("/buildingblock/modules")
-            if len(moduleroot) > 0:
-                os.makedirs(output_folder + '/modules')
-                for module in moduleroot.getchildren():
-                    html, guid = create_module_page(module)
-                    filename = output_folder + "/modules/" + guid + ".html"
-                    with open(filename, 'wt', encoding='utf-8') as file:
-                        file.write(html)
-
-            # Next up is creating all project pages
-            projectroot = bbtree.find("/buildingblock/projects")
-            if len(projectroot) > 0:
-                os.makedirs(output_folder + '/projects')
-                for project in projectroot.getchildren():
-                    html, guid = create_project_page(project)
-                    filename = output_folder + "/projects/" + guid + ".html"
-                    with open(filename, 'wt', encoding='utf-8') as file:
-                        file.write(html)
+            if incremental:
+                os.makedirs(output_folder, exist_ok=True)
+                manifest = read_manifest(output_folder)
+                # Every page is written again anyway, without compressed copies of other settings lingering
+                if manifest['fingerprint'] != template_fingerprint():
+                    output_writer.clear(output_folder)
+            else:
+                # clear output directory
+                output_writer.clear(output_folder)
+            if render:
+                with profiler.stage('static'):
+                    copy_static(output_folder, static)
+            global bbtree, bbindex, bbscripts
+            # When streaming the parse stage is only the index pass, the second pass is part of render
+            # The model stands in for the parse, unless the pages depend on files extracted this run
+            use_model = model_cache.folder is not None and not stream and not extract
+            model = None
+            with profiler.stage('parse'):
+                if use_model:
+                    model = model_cache.load(bb)
+                if model is not None:
+                    bbtree = None
+                    bbindex = model['index']
+                elif stream:
+                    bbindex = stream_index(buildingblock)
+                else:
+                    # Embedded resources easily exceed libxml2's default limit on text nodes
+                    bbtree = (etree.parse(buildingblock, etree.XMLParser(huge_tree=True)))
+                    bbindex = build_index(bbtree)
+                bbscripts = index_scripts(bbindex)
+                scripts_written.clear()
+            if extract:
+                with profiler.stage('extract'):
+                    buildingblock.seek(0)
+                    for guid, payload in extract_resources(buildingblock, output_folder).items():
+                        if guid in bbindex:
+                            bbindex[guid]['payload'] = payload
+            if use_model and model is None:
+                with profiler.stage('model'):
+                    model = build_model(bbtree)
+                    model_cache.store(bb, model)
+            if model is not None:
+                elements = ((kind, page) for kind, page, digest in model['pages'])
+            elif stream:
+                buildingblock.seek(0)
+                # Pages come out in document order, the elements are cleared as we go
+                elements = iterparse_elements(buildingblock)
+            else:
+                elements = tree_elements(bbtree)
+            search_index.reset()
+            digests = {page.guid: digest for kind, page, digest in model['pages']} if model else {}
+            if ndjson:
+                export = stack.enter_context(open(output_folder + '/model.ndjson', 'wt', encoding='utf-8'))
+                # The elements go on as model objects, changed_elements() needs the digests of their xml
+                elements = export_elements(export, elements, digests if incremental else None)
+            if incremental:
+                pages = {}
+                elements = changed_elements(output_folder, elements, manifest, pages, digests)
+                if search_index.enabled:
+                    search_index.load(output_folder)
+            with profiler.stage('render'):
+                if render:
+                    rendered = render_pages(output_folder, elements, jobs)
+                else:
+                    rendered = sum(1 for element in elements)
+            if incremental:
+                removed = remove_stale_pages(output_folder, manifest, pages)
+                remove_stale_scripts(output_folder)
+                search_index.retain(pages)
+                print("{} of {} pages rendered, {} removed".format(rendered, len(pages), removed))
+            if search_index.enabled and render:
+                with profiler.stage('search'):
+                    search_index.write(output_folder)
+                    html = environment().get_template('search.html').render()
+                    output_writer.write(output_folder + '/search.html', html)
+                search_index.reset()
+
+            write_graph(output_folder)
 
             # Finally we create an index page to tie it all together
-            index = {
-                'filename': bb,
-                'resources': [],
-                'projects': [],
-                'modules': []
-            }
-            for resource_element in bbtree.findall('/buildingblock/resources/resource'):
-                resourcetype = resource_element.find('.//properties/type').text
-                # This is one of those pesky inconsistencies in RESAM... #FML
-                if resourcetype == 'AMRESOURCEPACKAGE':
-                    name = resource_element.find('.//properties/name').text
+            index = index_dict(bb)
+            if render:
+                with profiler.stage('index'):
+                    shared = shared_scripts()
+                    html = environment().get_template('shared.html').render(shared=shared)
+                    output_writer.write(output_folder + '/shared.html', html)
+                    template = environment().get_template('index.html')
+                    html = template.render(index=index, search=search_index.enabled, shared=bool(shared))
+                    output_writer.write(output_folder + '/index.html', html)
+        # Only once every page is written, one that failed must not be up to date for the next run
+        if incremental:
+            write_manifest(output_folder, pages)
+        return index
+
+    except OutputError as err:
+        print("Error writing {}\n{}".format(output_folder, err))
+    except input_errors as err:
+        print("Error opening {}\n{}".format(bb, err))
+    except etree.XMLSyntaxError as err:
+        print("Error parsing {}\n{}".format(bb, err))
+    except MissingReferenceError as err:
+        print("Error processing {}\n{}".format(bb, err))
+
+
+def index_dict(bb):
+    """Returns the modules, projects and resources of the guid index by name, for the index page"""
+    index = {
+        'filename': bb,
+        'resources': [],
+        'projects': [],
+        'modules': []
+    }
+    for entry in bbindex.values():
+        index[entry['kind'] + 's'].append({
+            'name': entry['name'],
+            'guid': entry['guid']
+        })
+
+    # Sort them alphabetically
+    index['resources'] = sorted(index['resources'], key=lambda k: k['name'])
+    index['projects'] = sorted(index['projects'], key=lambda k: k['name'])
+    index['modules'] = sorted(index['modules'], key=lambda k: k['name'])
+    return index
+
+
+def process_batch(pattern, output_folder, jobs=1, **options):
+    """Process every Building Block in a folder or matching a glob, each into its own subfolder
+
+    All of them share this process and its template and highlight caches. With jobs > 1 the Building
+    Blocks themselves are spread over a pool of processes, each rendering its pages serially, unless
+    they all go into one archive. The stylesheets and images are written once, to the batch folder.
+    The remaining options are passed on to process_buildingblock()."""
+    files = batch_files(pattern)
+    if not files:
+        print("No Building Blocks found for {}".format(pattern))
+        return
+    if not options.get('incremental'):
+        output_writer.clear(output_folder)
+    elif not os.path.isdir(output_folder):
+        os.makedirs(output_folder)
+    if options.get('render', True):
+        with output_writer:
+            copy_static(output_folder)
+        # Written by now, every Building Block links to them instead of having copies of its own
+        options['static'] = output_folder
+
+    # Subfolders are named after the files, numbered if a glob matches the same name twice
+    members = []
+    for bb in files:
+        folder = buildingblock_name(bb)
+        if folder in [member[1] for member in members]:
+            folder = '{}-{}'.format(folder, len(members))
+        members.append((bb, folder))
+
+    if jobs < 2 or output_writer.archive is not None:
+        results = [process_batch_member(bb, output_folder + '/' + folder, options) for bb, folder in members]
+    else:
+        cache = (highlight_cache.folder, highlight_cache.maxbytes)
+        settings = (profiler.enabled, search_index.enabled, model_cache.folder, inline_limit,
+                    output_writer.suffixes)
+        with multiprocessing.Pool(jobs, initializer=init_worker, initargs=({}, cache, settings)) as pool:
+            pending = [pool.apply_async(process_batch_member, (bb, output_folder + '/' + folder, options))
+                       for bb, folder in members]
+            results = [result.get() for result in pending]
+
+    batch = []
+    for (bb, folder), (index, stats) in zip(members, results):
+        merge_worker_stats(stats)
+        buildingblock = {
+            'filename': bb,
+            'folder': folder,
+            'processed': index is not None
+        }
+        if index is not None:
+            for kind in ['resources', 'projects', 'modules']:
+                buildingblock[kind] = len(index[kind])
+        batch.append(buildingblock)
+
+    if options.get('render', True):
+        template = environment().get_template('batch.html')
+        html = template.render(batch=batch)
+        output_writer.write(output_folder + '/index.html', html)
+
+
+def process_batch_member(bb, output_folder, options):
+    """process_buildingblock() for process_batch(), returns the index and the statistics of the run"""
+    hits, misses = highlight_cache.hits, highlight_cache.misses
+    index = process_buildingblock(bb, output_folder, **options)
+    return index, worker_stats(hits, misses)
+
+
+def open_buildingblock(bb):
+    """Opens a Building Block for reading bytes, '-' being stdin, decompressing it on the fly if compressed
+
+    Compressed exports are recognized by their first bytes, whatever their name, see input_formats.
+    Of a zip file the first .xml member is read. Going back to the start with seek(0) works for all
+    of them, by decompressing again, but not for stdin."""
+    source = sys.stdin.buffer if bb == '-' else open(bb, 'rb')
+    magic = source.peek(6)[:6]
+    for signature, decompressor in input_formats.values():
+        if magic.startswith(signature):
+            break
+    else:
+        return source
+    if bb == '-':
+        if decompressor is None:
+            raise IOError("A zip file can't be read from stdin")
+        return decompressor(source)
+    # Opened by name they close the file themselves
+    source.close()
+    if decompressor is not None:
+        return decompressor(bb)
+    try:
+        with zipfile.ZipFile(bb) as archive:
+            names = [name for name in archive.namelist() if name.lower().endswith('.xml')]
+            if not names:
+                raise IOError("No .xml file in {}".format(bb))
+            # The member keeps the archive file open until it is closed itself
+            return archive.open(names[0])
+    except zipfile.BadZipFile as err:
+        raise IOError(err)
+
+
+def buildingblock_name(bb):
+    """Returns the file name of a Building Block without the .xml and compression extensions"""
+    name = os.path.basename(bb)
+    for extension in input_formats:
+        if name.lower().endswith(extension):
+            name = name[:-len(extension)]
+            break
+    return os.path.splitext(name)[0]
+
+
+def batch_files(pattern):
+    """Returns the Building Blocks in a folder, compressed ones included, or matching a glob, sorted"""
+    if os.path.isdir(pattern):
+        # Compressed exports as .xml.gz and the like, a zip file may have any name
+        extensions = ['.xml', '.zip'] + ['.xml' + extension for extension in input_formats if extension != '.zip']
+        return sorted(name for extension in extensions
+                      for name in glob.glob(os.path.join(pattern, '*' + extension)))
+    return sorted(glob.glob(pattern))
+
+
+def stats_buildingblock(bb, largest=10):
+    """Prints the number of resources, modules, projects and tasks per type in a Building Block, the size of
+    the embedded resource files and the largest of them and of the scripts
+
+    A single streaming pass, nothing is written and the templates are never set up, so it is quick to start
+    and stays flat in memory. The embedded files are only counted, see PayloadCounter. Returns the
+    statistics, or None if the file could not be read."""
+    stats = {
+        'filename': bb,
+        'kinds': collections.Counter(),
+        'tasks': collections.Counter(),
+        'payload': 0,
+        'payloads': [],
+        'scripts': []
+    }
+    try:
+        with open_buildingblock(bb) as buildingblock:
+            for kind, element, payload in iterparse_payloads(buildingblock):
+                stats['kinds'][kind] += 1
+                properties = element.find('properties')
+                guid = properties.findtext('guid')
+                if kind == 'resource':
+                    name = resource_name(properties, properties.findtext('type'))
+                    if payload:
+                        stats['payload'] += payload
+                        push_largest(stats['payloads'], largest, (payload, name, guid))
+                elif kind == 'module':
+                    name = properties.findtext('name')
+                    for task in element.iterfind('tasks/task'):
+                        # The hidden one holds the module parameters, not a task of the report
+                        if task.get('hidden') is not None:
+                            continue
+                        tasktype, text = task_script(task)
+                        stats['tasks'][tasktype] += 1
+                        if text:
+                            size = len(text.encode('utf-8'))
+                            push_largest(stats['scripts'], largest, (size, tasktype, name, guid))
+    except input_errors + (etree.XMLSyntaxError,) as err:
+        print("Error reading {}\n{}".format(bb, err))
+        return None
+
+    lines = ['{:<32}{:>10}'.format(bb, 'Count')]
+    for kind in ['resource', 'module', 'project']:
+        lines.append('{:<32}{:>10}'.format(kind.capitalize() + 's', stats['kinds'][kind]))
+    lines.append('')
+    lines.append('{:<32}{:>10}'.format('Task type', 'Count'))
+    for tasktype, count in sorted(stats['tasks'].items()):
+        lines.append('{:<32}{:>10}'.format(task_displayname.get(tasktype, tasktype), count))
+    lines.append('')
+    lines.append('Embedded resource files: {:.1f} MB'.format(stats['payload'] / 1048576))
+    for size, name, guid in sorted(stats['payloads'], reverse=True):
+        lines.append('{:>10.1f} KB  {} {}'.format(size / 1024, name, guid))
+    lines.append('')
+    lines.append('Largest scripts')
+    for size, tasktype, name, guid in sorted(stats['scripts'], reverse=True):
+        lines.append('{:>10.1f} KB  {:<15}{} {}'.format(size / 1024, tasktype, name, guid))
+    print('\n'.join(lines))
+    return stats
+
+
+def list_buildingblock(bb, show_file=False):
+    """Prints the kind, guid and name of every resource, module and project in a Building Block, tab separated
+
+    With show_file set every line starts with bb, for listing a batch. Like stats_buildingblock() a single
+    streaming pass. Returns the number of elements, or None if the file could not be read."""
+    count = 0
+    try:
+        with open_buildingblock(bb) as buildingblock:
+            for kind, element in iterparse_elements(buildingblock):
+                properties = element.find('properties')
+                if kind == 'resource':
+                    name = resource_name(properties, properties.findtext('type'))
                 else:
-                    name = resource_element.find('.//properties/file').text
-                project = {
-                    'name': name,
-                    'guid': resource_element.find('.//properties/guid').text
-                }
-                index['resources'].append(project)
-
-            for project_element in bbtree.findall('/buildingblock/projects/project'):
-                project = {
-                    'name': project_element.find('.//properties/name').text,
-                    'guid': project_element.find('.//properties/guid').text
-                }
-                index['projects'].append(project)
-
-            for module_element in bbtree.findall('/buildingblock/modules/module'):
-                module = {
-                    'name': module_element.find('.//properties/name').text,
-                    'guid': module_element.find('.//properties/guid').text
-                }
-                index['modules'].append(module)
-
-            # Sort them alphabetically
-            index['resources'] = sorted(index['resources'], key=lambda k: k['name'])
-            index['projects'] = sorted(index['projects'], key=lambda k: k['name'])
-            index['modules'] = sorted(index['modules'], key=lambda k: k['name'])
-
-            template = env.get_template('index.html')
-            html = template.render(index=index)
-            filename = output_folder + '/index.html'
-            with open(filename, 'wt', encoding='utf-8') as file:
-                file.write(html)
+                    name = properties.findtext('name')
+                fields = [kind, properties.findtext('guid'), name or '']
+                print('\t'.join([bb] + fields if show_file else fields))
+                count += 1
+    except BrokenPipeError:
+        # Not a problem of the file, main() handles it
+        raise
+    except input_errors + (etree.XMLSyntaxError,) as err:
+        print("Error reading {}\n{}".format(bb, err))
+        return None
+    return count
+
+
+def push_largest(heap, largest, item):
+    """Keeps the largest items in a min heap, the smallest of them drops off first"""
+    heapq.heappush(heap, item)
+    if len(heap) > largest:
+        heapq.heappop(heap)
+
+
+def diff_buildingblocks(old_bb, new_bb, output_folder):
+    """Compares two exports of the same environment and writes diff.html and diff.json to the output folder
+
+    Modules, projects and resources are matched by guid and compared by a hash of their canonical xml.
+    The old export is read first for its hashes only, the new one keeps the elements that differ as
+    serialized xml and a second pass over the old export compares those field by field, see
+    diff_element(). Embedded resource files are only compared by hash and length, see diff_payload().
+    Neither export is ever held as a whole. Returns the report, or None on errors."""
+    try:
+        print("Comparing {} with {}".format(old_bb, new_bb))
+        output_writer.clear(output_folder)
+        copy_static(output_folder)
+        report = {
+            'old': old_bb,
+            'new': new_bb,
+            'added': [],
+            'removed': [],
+            'changed': [],
+            'unchanged': 0
+        }
+        with profiler.stage('parse'):
+            with open_buildingblock(old_bb) as buildingblock:
+                digests = {}
+                for kind, element in iterparse_elements(buildingblock, remove_blank_text=True):
+                    entry = diff_entry(kind, element)
+                    digests[entry['guid']] = entry, canonical_digest(element)
+        with profiler.stage('diff'):
+            changed = {}
+            with open_buildingblock(new_bb) as buildingblock:
+                for kind, element in iterparse_elements(buildingblock, remove_blank_text=True):
+                    entry = diff_entry(kind, element)
+                    if entry['guid'] not in digests:
+                        report['added'].append(entry)
+                    elif digests.pop(entry['guid'])[1] != canonical_digest(element):
+                        # Kept without the embedded file, only its hash and length
+                        with without_payload(element) as payload:
+                            changed[entry['guid']] = (etree.tostring(element, with_tail=False),
+                                                      payload_summary(payload) if payload is not None else None)
+                    else:
+                        report['unchanged'] += 1
+            # Whatever is left was not in the new export
+            report['removed'] = [entry for entry, digest in digests.values()]
+            if changed:
+                with open_buildingblock(old_bb) as buildingblock:
+                    for kind, element in iterparse_elements(buildingblock, remove_blank_text=True):
+                        guid = element.findtext('properties/guid')
+                        if guid in changed:
+                            xml, new_payload = changed.pop(guid)
+                            new_element = etree.fromstring(xml)
+                            entry = diff_entry(kind, new_element)
+                            entry['oldname'] = diff_entry(kind, element)['name']
+                            entry['changes'] = []
+                            with without_payload(element) as payload:
+                                old_payload = payload_summary(payload) if payload is not None else None
+                                diff_element(element, new_element, '', entry['changes'])
+                            change = diff_payload(old_payload, new_payload)
+                            if change is not None:
+                                entry['changes'].append(change)
+                            report['changed'].append(entry)
+
+        for key in ['added', 'removed', 'changed']:
+            report[key] = sorted(report[key], key=lambda k: (k['kind'], k['name'] or '', k['guid']))
+        with profiler.stage('index'):
+            template = environment().get_template('diff.html')
+            html = template.render(diff=report)
+            output_writer.write(output_folder + '/diff.html', html)
+            output_writer.write(output_folder + '/diff.json', json.dumps(report, indent=1))
+        print("{} added, {} removed, {} changed, {} unchanged".format(
+            len(report['added']), len(report['removed']), len(report['changed']), report['unchanged']))
+        return report
+
+    except OutputError as err:
+        print("Error writing {}\n{}".format(output_folder, err))
+    except input_errors + (etree.XMLSyntaxError,) as err:
+        print("Error comparing {} with {}\n{}".format(old_bb, new_bb, err))
+
+
+def diff_entry(kind, element):
+    """Returns the kind, guid and name of a resource, module or project element for the diff report"""
+    entry = index_entry(kind, element)
+    return {
+        'kind': kind,
+        'guid': entry['guid'],
+        'name': entry['name']
+    }
 
-    except IOError as err:
-        print("Error opening {}\n{}".format(bb, err))
 
+def canonical_digest(element):
+    """Returns a hash of the canonical xml of element, attribute order and blank text don't count
+
+    Blank text is only gone if the element was parsed with remove_blank_text, as the diff does. The
+    embedded file of a resource is hashed on its own, see payload_summary()."""
+    with without_payload(element) as payload:
+        digest = hashlib.sha1(etree.tostring(element, method='c14n', with_tail=False))
+    if payload is not None:
+        digest.update('|{}|{}'.format(*payload_summary(payload)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def payload_summary(payload):
+    """Returns the hash and length of the text of the embedded file element of a resource"""
+    # Straight to bytes, without a str of it in between
+    data = etree.tostring(payload, method='text', encoding='utf-8', with_tail=False)
+    return hashlib.sha1(data).hexdigest(), len(data)
+
+
+def diff_payload(old, new):
+    """Returns the change of the embedded file of a resource from the payload_summary() of both, or None"""
+    if old == new:
+        return None
+    old_size, new_size = ['{} bytes'.format(summary[1]) if summary else None for summary in [old, new]]
+    change = 'changed' if old and new else 'added' if new else 'removed'
+    return diff_change(resource_payload_tag, change, old_size, new_size)
+
+
+def diff_element(old, new, path, changes):
+    """Appends the differences between two versions of an element to changes
+
+    Children are matched by diff_children() and only descended into if their hashes differ. A
+    change is a dictionary with the path below the top level element, added, removed or changed, and
+    the old and new value. Multiline text such as scripts gets a unified diff in lines instead."""
+    for name in sorted(set(old.attrib) | set(new.attrib)):
+        if old.get(name) != new.get(name):
+            changes.append(diff_change(path + '/@' + name, 'changed', old.get(name), new.get(name)))
+    if len(old) == 0 and len(new) == 0:
+        if (old.text or '') != (new.text or ''):
+            changes.append(diff_text(path, old, new))
+        return
+    old_children = diff_children(old)
+    new_children = diff_children(new)
+    for label, child in new_children.items():
+        child_path = path + '/' + label if path else label
+        if label not in old_children:
+            changes.append(diff_change(child_path, 'added', None, diff_summary(child)))
+        elif canonical_digest(old_children[label]) != canonical_digest(child):
+            diff_element(old_children[label], child, child_path, changes)
+    for label, child in old_children.items():
+        if label not in new_children:
+            child_path = path + '/' + label if path else label
+            changes.append(diff_change(child_path, 'removed', diff_summary(child), None))
+
+
+def diff_children(element):
+    """Returns the children of element by label, tag[guid] for tasks and linked modules, param[name] for parameters
+
+    Other children are labeled by their tag, numbered from the second one on if it repeats."""
+    children = collections.OrderedDict()
+    for child in element:
+        key = child.findtext('properties/guid') or child.get('guid')
+        if key is None and child.tag != 'properties':
+            key = child.findtext('guid')
+        if key is None and child.tag == 'param':
+            key = child.findtext('name')
+        label = '{}[{}]'.format(child.tag, key) if key else child.tag
+        unique, number = label, 1
+        while unique in children:
+            number += 1
+            unique = '{}[{}]'.format(label, number)
+        children[unique] = child
+    return children
+
+
+def diff_change(path, change, old, new, lines=None):
+    """Returns a change for the diff report, see diff_element()"""
+    return {
+        'path': path,
+        'change': change,
+        'old': old,
+        'new': new,
+        'lines': lines
+    }
 
-def parameter_to_dict(p):
-    """Retruns a dictionary from a param xml element"""
-    value_element = p.find('.//value1')
-    value = ""
-    if value_element is not None:
-        value = value_element.text
-
-    # Input tab
-    on_import = p.find('.//inputtiming/importbb').text == 'yes'
-    import_prev = p.xpath('.//inputtiming/importbb/@showprev')[0] == 'yes'
-    on_schedule = p.xpath('.//inputtiming/schedulejob')[0] == 'yes'
-    sched_prev = p.xpath('.//inputtiming/schedulejob/@showprev')[0] == 'yes'
-    # Cannot be sure these exist, but assume False if missing
+
+def diff_text(path, old, new):
+    """Returns the change of a text field, with a unified diff for scripts and registry files"""
+    old_text, new_text = old.text or '', new.text or ''
+    # Embedded resource files are compared apart, see diff_payload()
+    if new.tag == 'regfile':
+        try:
+            old_text, new_text = unreszlib(old_text) if old_text else '', unreszlib(new_text) if new_text else ''
+        except (ValueError, zlib.error):
+            pass
+    if '\n' not in old_text and '\n' not in new_text:
+        return diff_change(path, 'changed', old.text, new.text)
+    lines = list(difflib.unified_diff(old_text.splitlines(), new_text.splitlines(), lineterm='', n=2))
+    # The file headers say nothing here
+    return diff_change(path, 'changed', None, None, lines[2:])
+
+
+def diff_summary(element):
+    """Returns the text of an added or removed leaf element, or the type and name of a larger one"""
+    if len(element) == 0:
+        return element.text
+    summary = [element.findtext(name) for name in ['properties/type', 'properties/description',
+                                                   'properties/name', 'name']]
+    return ' '.join(text for text in summary if text) or None
+
+
+def serve_buildingblock(bb, port=8000, cache_size=64 * 1024 * 1024):
+    """Serves the report of a Building Block on localhost until interrupted, see ReportServer
+
+    Nothing is written, pages are rendered when they are requested. Time to the first page is the parse."""
+    try:
+        server = ReportServer(('localhost', port), bb, cache_size)
+    except (IOError, etree.XMLSyntaxError) as err:
+        print("Error serving {}\n{}".format(bb, err))
+        return
+    print("Serving {} on http://localhost:{}/, press Ctrl+C to stop".format(bb, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    print("Page cache: {} hits, {} misses".format(server.cache.hits, server.cache.misses))
+
+
+def render_pages(output_folder, elements, jobs=1):
+    """Writes the page for every (kind, element) pair, spread over a pool of processes if jobs > 1
+
+    Workers get the guid index once through their initializer and every element as serialized xml or
+    model object. They send back the rendered files, which output_writer writes while they go on.
+    Returns the number of pages."""
+    count = 0
+    if jobs < 2:
+        for kind, element in elements:
+            write_page(output_folder, kind, element)
+            count += 1
+        return count
+    # Elements can't be pickled and the workers don't need them, the name and type do for cross references
+    index = {guid: dict(entry, element=None) for guid, entry in bbindex.items()}
+    cache = (highlight_cache.folder, highlight_cache.maxbytes)
+    options = (profiler.enabled, search_index.enabled, model_cache.folder, inline_limit, output_writer.suffixes)
+    with multiprocessing.Pool(jobs, initializer=init_worker, initargs=(index, cache, options)) as pool:
+        # Bound the number of queued pages, otherwise a streamed Building Block ends up in memory after all
+        pending = collections.deque()
+        for kind, element in elements:
+            if not isinstance(element, Model):
+                with without_payload(element):
+                    xml = etree.tostring(element, with_tail=False)
+                element = xml
+            pending.append(pool.apply_async(render_page_worker, (output_folder, kind, element)))
+            count += 1
+            if len(pending) >= jobs * 4:
+                write_worker_files(*pending.popleft().get())
+        # get() re-raises whatever went wrong in the worker, MissingReferenceError included
+        for result in pending:
+            write_worker_files(*result.get())
+    return count
+
+
+def export_elements(file, elements, digests=None):
+    """Writes every (kind, element) pair to file as a line of json and passes it on as model object
+
+    The lines hold the same fields as the pages, cross references resolved and registry files decoded,
+    with the kind added. With digests given the element_digest() of every xml element goes in there."""
+    for kind, element in elements:
+        with profiler.stage('render/export'):
+            page = page_model(kind, element)
+            if digests is not None and page is not element:
+                digests[page.guid] = element_digest(element)
+            file.write(json.dumps(dict({'kind': kind}, **page.to_dict()), separators=(',', ':')) + '\n')
+        yield kind, page
+
+
+def static_files():
+    """Returns (source, name) for the stylesheets and images, name being the path in the output folder"""
+    static = [(os.path.join(basedir, 'templates', name), name) for name in ['bbreport.css', 'vs.css']]
+    for name in sorted(os.listdir(os.path.join(basedir, 'img'))):
+        static.append((os.path.join(basedir, 'img', name), 'img/' + name))
+    return static
+
+
+def copy_static(output_folder, static=None):
+    """Copies the stylesheets and images to the output folder, skipping files that are already identical
+
+    The copies are left to output_writer, within a run they happen while the parse and render go on.
+    With static set they are hard links to the copies in that folder instead, as in a batch."""
+    for source, name in static_files():
+        if static is None or output_writer.archive is not None:
+            output_writer.copy(source, output_folder + '/' + name)
+        else:
+            output_writer.link(static + '/' + name, output_folder + '/' + name)
+
+
+def changed_elements(output_folder, elements, manifest, pages, digests=None):
+    """Yields the (kind, element) pairs whose page is out of date according to the previous manifest
+
+    The digest of every element is recorded in pages, whether it is yielded or not. Model objects
+    have no xml left to digest, theirs were computed by build_model() and are looked up in digests."""
+    # A template change invalidates every page, so the digests are only comparable with the same templates
+    fingerprint = template_fingerprint()
+    previous = manifest['pages'] if manifest.get('fingerprint') == fingerprint else {}
+    for kind, element in elements:
+        if isinstance(element, Model):
+            guid = element.guid
+            digest = digests[guid]
+        else:
+            guid = element.find('properties/guid').text
+            digest = element_digest(element)
+        pages[guid] = {'kind': kind, 'digest': digest}
+        if previous.get(guid) == pages[guid] and os.path.exists(page_filename(output_folder, kind, guid)):
+            continue
+        yield kind, element
+
+
+def element_digest(element):
+    """Returns a hash of the element's xml and the names and types of everything it refers to
+
+    The embedded file of a resource is left out, its page only shows the properties."""
+    with without_payload(element):
+        xml = etree.tostring(element, with_tail=False)
+    digest = hashlib.sha1(xml)
+    # Renaming a linked module changes this page as well, even though its own xml stays the same.
+    # So does a new version of an extracted resource which a PowerShell task shows inline.
+    for guid in sorted(set(guid_pattern.findall(xml))):
+        entry = bbindex.get(guid.decode('ascii'))
+        if entry is not None:
+            payload = entry.get('payload') or {}
+            digest.update('{kind}|{guid}|{name}|{type}'.format(**entry).encode('utf-8'))
+            digest.update('|{}'.format(payload.get('crc32')).encode('utf-8'))
+    # Pages list what refers to them, which is not in their own xml
+    guid = element.find('properties/guid').text
+    for usedby in used_by(guid):
+        digest.update('{guid}|{name}|{relation}|{detail}'.format(**usedby).encode('utf-8'))
+    # A script other modules have as well goes on a page of its own, see cap_blob()
+    for script, tasktype, size in bbindex[guid]['scripts']:
+        digest.update('|{}|{}'.format(script, len(bbscripts[script])).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def template_fingerprint():
+    """Returns a hash of the version, the inline limit, the compressed copies and all templates, pages rendered
+    otherwise are stale"""
+    digest = hashlib.sha1('{}|{}|{}'.format(__version__, inline_limit, output_writer.suffixes).encode('utf-8'))
+    folder = os.path.join(basedir, 'templates')
+    for name in sorted(os.listdir(folder)):
+        with open(os.path.join(folder, name), 'rb') as file:
+            digest.update(name.encode('utf-8'))
+            digest.update(file.read())
+    return digest.hexdigest()
+
+
+def read_manifest(output_folder):
+    """Returns the manifest of the previous incremental run, or an empty one"""
     try:
-        sched_erase = p.xpath('.//inputtiming/schedulejob/@eraseprev')[0] == 'yes'
-    except IndexError:
-        sched_erase = False
+        with open(output_folder + '/manifest.json', 'rt', encoding='utf-8') as file:
+            return json.load(file)
+    except (IOError, ValueError):
+        return {'fingerprint': None, 'pages': {}}
+
+
+def write_manifest(output_folder, pages):
+    """Writes the manifest with the digest of every page for the next incremental run, after the run's pages"""
+    manifest = {
+        'fingerprint': template_fingerprint(),
+        'pages': pages
+    }
+    output_writer.write(output_folder + '/manifest.json', json.dumps(manifest, indent=1, sort_keys=True))
+
+
+def remove_stale_pages(output_folder, manifest, pages):
+    """Deletes the pages of elements which were in the previous manifest but are gone now"""
+    removed = 0
+    for guid, page in manifest['pages'].items():
+        # The manifest is only read back, it might have been edited
+        if guid not in pages and valid_guid(guid) and page.get('kind') in ['resource', 'module', 'project']:
+            filename = page_filename(output_folder, page['kind'], guid)
+            for name, compress in output_writer.compressed_copies(filename):
+                try:
+                    os.remove(name)
+                except FileNotFoundError:
+                    pass
+            try:
+                os.remove(filename)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            # Extracted resource files
+            shutil.rmtree(output_folder + '/' + page['kind'] + 's/' + guid, ignore_errors=True)
+    return removed
+
+
+def remove_stale_scripts(output_folder):
+    """Deletes the files in scripts/ of scripts no task has anymore"""
+    folder = output_folder + '/scripts'
+    if os.path.isdir(folder):
+        # Named by the hash of the script, compressed copies included
+        for name in os.listdir(folder):
+            if name.split('.')[0] not in bbscripts:
+                os.remove(os.path.join(folder, name))
+
+
+def init_worker(index, cache, options):
+    """Pool initializer, sets the guid index used for cross references, the highlight cache folder, profiling,
+    search, the model cache folder, the inline limit and the compressed copies"""
+    global bbindex, bbscripts, inline_limit
+    bbindex = index
+    bbscripts = index_scripts(index)
+    scripts_written.clear()
+    folder, maxbytes = cache
+    if folder is not None:
+        highlight_cache.open(folder, maxbytes)
+    profiler.enabled, search_index.enabled, folder, inline_limit, output_writer.suffixes = options
+    if folder is not None:
+        model_cache.open(folder)
+    # Forked in the middle of a run, without the writer threads. Files go back to the parent instead.
+    # A writer thread might have held a lock at that moment, which nobody would release here.
+    output_writer.lock = threading.Lock()
+    output_writer.archive_lock = threading.Lock()
+    output_writer.queue = None
+    output_writer.workers = []
+    output_writer.collect()
+
+
+def render_page_worker(output_folder, kind, element):
+    """page_files() for an element passed on by render_pages(), returns the files and the worker's statistics"""
+    hits, misses = highlight_cache.hits, highlight_cache.misses
+    if not isinstance(element, Model):
+        element = etree.fromstring(element)
+    files = page_files(output_folder, kind, element)
+    return files, worker_stats(hits, misses)
+
+
+def write_worker_files(files, stats):
+    """Hands the files rendered by render_page_worker() to output_writer and merges the statistics
+
+    Every worker writes a script once, so the same one may come from another worker already."""
+    merge_worker_stats(stats)
+    with profiler.stage('render/write'):
+        for filename, text in files:
+            if os.path.basename(os.path.dirname(filename)) == 'scripts':
+                if filename in scripts_written:
+                    continue
+                scripts_written.add(filename)
+            output_writer.write(filename, text)
+
+
+def worker_stats(hits, misses):
+    """Returns the highlight cache hits and misses since the given counts, the profile, search pages and written
+    files since last time"""
+    return (highlight_cache.hits - hits, highlight_cache.misses - misses, profiler.collect(),
+            search_index.collect(), output_writer.collect())
+
+
+def merge_worker_stats(stats):
+    """Adds the statistics returned by worker_stats() to our own"""
+    hits, misses, profile, pages, written = stats
+    highlight_cache.hits += hits
+    highlight_cache.misses += misses
+    profiler.merge(profile)
+    search_index.merge(pages)
+    output_writer.merge(written)
+
+
+def write_page(output_folder, kind, element):
+    """Renders the page for a resource, module or project element or model object into its kind's subfolder"""
+    files = page_files(output_folder, kind, element)
+    # Only waits if the writer threads are behind
+    with profiler.stage('render/write'):
+        for filename, text in files:
+            output_writer.write(filename, text)
+
+
+def page_files(output_folder, kind, element):
+    """Renders the page for a resource, module or project element or model object, returns (filename, text)
+
+    for the page and, for a module, the scripts and registry files not written yet this run, see script_files()."""
+    start = time.perf_counter()
+    page = page_model(kind, element)
+    if not valid_guid(page.guid):
+        print("Skipping the page of {} {!r}, its guid is not a guid".format(kind, page.guid))
+        return []
+    html = render_page(kind, page)
+    if search_index.enabled:
+        search_index.add(kind, page)
+    files = [(page_filename(output_folder, kind, page.guid), html)]
+    if kind == 'module':
+        files.extend(script_files(output_folder, page))
+    if profiler.enabled:
+        profiler.add_page(time.perf_counter() - start, kind, page.guid)
+    return files
+
+
+def script_files(output_folder, module):
+    """Returns (filename, text) for the scripts and registry files of the module page not written yet this run
+
+    They go in scripts/ named by their hash, see cap_blob(). Those within inline_limit are highlighted."""
+    files = []
+    for task in module.tasks:
+        if task.blob is None:
+            continue
+        filename = output_folder + '/scripts/' + task.blob['link']
+        if filename in scripts_written:
+            continue
+        scripts_written.add(filename)
+        if filename.endswith('.html'):
+            files.append((filename, render_page('script', task.blob)))
+        else:
+            files.append((filename, task.blob['text']))
+    return files
+
+
+def page_filename(output_folder, kind, guid):
+    """Returns the path of the page for a resource, module or project"""
+    return output_folder + '/' + kind + 's/' + guid + '.html'
+
+
+def build_model(tree):
+    """Returns the model of a parsed Building Block for the model cache, the guid index and every page
+
+    Pages are (kind, model object, digest) in the order of tree_elements(), digest as element_digest()."""
+    pages = []
+    for kind, element in tree_elements(tree):
+        pages.append((kind, page_model(kind, element), element_digest(element)))
+    index = {guid: dict(entry, element=None) for guid, entry in bbindex.items()}
+    return {'index': index, 'pages': pages}
+
+
+def page_model(kind, element):
+    """Returns the model object of a resource, module or project element, or element if it is one already"""
+    if isinstance(element, Model):
+        return element
+    return page_models[kind](page_dicts[kind](element))
+
+
+def build_index(tree):
+    """Returns a dictionary of all modules, projects and resources in the tree keyed by guid"""
+    index = {}
+    for kind, element in tree_elements(tree):
+        entry = index_entry(kind, element)
+        entry['element'] = element
+        index[entry['guid']] = entry
+    link_references(index)
+    return index
+
+
+def tree_elements(tree):
+    """Yields (kind, element) for every resource, module and project in a parsed tree"""
+    # Resources first, then modules and finally the projects linking them
+    for kind in ['resource', 'module', 'project']:
+        for element in tree.findall('./buildingblock/' + kind + 's/' + kind):
+            yield kind, element
+
+
+def stream_index(source):
+    """Returns the same dictionary as build_index from a single iterparse pass, without the elements"""
+    index = {}
+    for kind, element in iterparse_elements(source):
+        entry = index_entry(kind, element)
+        entry['element'] = None
+        index[entry['guid']] = entry
+    link_references(index)
+    return index
+
+
+def index_entry(kind, element):
+    """Returns the guid, name, type and outgoing references of a resource, module or project element"""
+    properties = element.find('properties')
+    entrytype = None
+    if kind == 'resource':
+        entrytype = properties.find('type').text
+        name = resource_name(properties, entrytype)
+    else:
+        name = properties.find('name').text
+    return {
+        'kind': kind,
+        'guid': properties.find('guid').text,
+        'name': name,
+        'type': entrytype,
+        'uses': element_references(kind, element),
+        'usedby': [],
+        'scripts': element_scripts(kind, element)
+    }
 
+
+def element_scripts(kind, element):
+    """Returns (hash, task type, size) for the scripts and registry files a module's page shows, as stored"""
+    scripts = []
+    if kind == 'module':
+        for task in element.iterfind('tasks/task'):
+            tasktype, text = task_script(task)
+            if text and task.get('hidden') is None:
+                scripts.append((script_digest(text), tasktype, len(text.encode('utf-8'))))
+    return scripts
+
+
+def task_script(task):
+    """Returns the type of a task element and its script or registry file as stored, None if it has none"""
+    tasktype = task.findtext('properties/type')
+    if tasktype not in script_settings:
+        return tasktype, None
+    # A script tab the commandline doesn't refer to is ignored, as is one of a PowerShell resource file
+    commandline = task.findtext('settings/commandline') or ''
+    if tasktype in ['COMMAND', 'LINUX_COMMAND'] and '@[SCRIPT]' not in commandline.upper():
+        return tasktype, None
+    if tasktype == 'PWRSHELL' and task.findtext('settings/usescript') != 'yes':
+        return tasktype, None
+    return tasktype, task.findtext(script_settings[tasktype])
+
+
+def script_digest(text):
+    """Returns the hash a script or registry file is known by in bbscripts and named by in scripts/"""
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def index_scripts(index):
+    """Returns the (module guid, task type, size) of every task having a script by the hash of the script"""
+    scripts = {}
+    for entry in index.values():
+        for digest, tasktype, size in entry['scripts']:
+            scripts.setdefault(digest, []).append((entry['guid'], tasktype, size))
+    return scripts
+
+
+def shared_scripts():
+    """Returns the scripts more than one task has for the shared scripts page, most bytes duplicated first"""
+    shared = []
+    for digest, uses in bbscripts.items():
+        if len(uses) < 2:
+            continue
+        modules = collections.Counter(guid for guid, tasktype, size in uses)
+        shared.append({
+            'digest': digest,
+            'displayname': task_displayname.get(uses[0][1], uses[0][1]),
+            'size': uses[0][2],
+            'tasks': len(uses),
+            'modules': sorted([{'guid': guid, 'name': bbindex[guid]['name'], 'count': count}
+                               for guid, count in modules.items()], key=lambda k: (k['name'] or '', k['guid']))
+        })
+    return sorted(shared, key=lambda k: (-k['size'] * (k['tasks'] - 1), k['digest']))
+
+
+def element_references(kind, element):
+    """Returns the references of a module or project to other elements as (guid, relation, detail)
+
+    Relations are the keys of reference_displayname. Parameter links carry the names of both
+    parameters as detail, downloads and PowerShell resource files the task guid."""
+    references = []
+    if kind == 'module':
+        params = element.findall('tasks/task/parameters/param')
+        for task in element.findall('tasks/task'):
+            tasktype = task.findtext('properties/type')
+            taskguid = task.findtext('properties/guid')
+            if tasktype in ['DOWNLOAD', 'LINUX_DOWNLOAD']:
+                for resourceguid in (task.findtext('settings/resources') or '').split(','):
+                    if resourceguid:
+                        references.append((resourceguid, 'download', taskguid))
+            elif tasktype == 'PWRSHELL' and task.findtext('settings/usescript') == 'no':
+                references.append((task.findtext('settings/resourceguid'), 'powershell', taskguid))
+    elif kind == 'project':
+        params = element.findall('properties/parameters/param')
+        for module in element.findall('modules/module'):
+            references.append((module.findtext('guid'), 'module', None))
+    else:
+        params = []
+    for param in params:
+        for link in param.findall('selection/module'):
+            detail = '{} -> {}'.format(param.findtext('name'), link.findtext('param'))
+            references.append((link.get('guid'), 'parameter', detail))
+    return references
+
+
+def link_references(index):
+    """Fills the usedby list of every index entry from the uses of all others"""
+    for entry in index.values():
+        for guid, relation, detail in entry['uses']:
+            if guid in index:
+                index[guid]['usedby'].append((entry['guid'], relation, detail))
+
+
+def used_by(guid):
+    """Returns the elements referring to guid as dictionaries for the templates, sorted by kind and name"""
+    usedby = []
+    for source, relation, detail in bbindex[guid]['usedby'] if guid in bbindex else []:
+        entry = bbindex[source]
+        usedby.append({
+            'guid': source,
+            'kind': entry['kind'],
+            'name': entry['name'],
+            'relation': reference_displayname[relation],
+            'detail': detail if relation == 'parameter' else None
+        })
+    return sorted(usedby, key=lambda k: (k['kind'], k['name'] or '', k['detail'] or ''))
+
+
+def write_graph(output_folder):
+    """Writes the references between all modules, projects and resources as graph.json, for impact analysis"""
+    graph = {
+        'nodes': {},
+        'edges': []
+    }
+    for guid, entry in bbindex.items():
+        graph['nodes'][guid] = {'kind': entry['kind'], 'name': entry['name'], 'type': entry['type']}
+        for target, relation, detail in entry['uses']:
+            graph['edges'].append({'source': guid, 'target': target, 'relation': relation, 'detail': detail})
+    # Reverse adjacency, the question before changing a shared module
+    graph['usedby'] = {guid: sorted(set(source for source, relation, detail in entry['usedby']))
+                       for guid, entry in bbindex.items() if entry['usedby']}
+    output_writer.write(output_folder + '/graph.json', json.dumps(graph, indent=1, sort_keys=True))
+
+
+def iterparse_elements(source, remove_blank_text=False):
+    """Yields (kind, element) for every complete resource, module and project in source
+
+    Elements are cleared once the caller is done with them, so only one is held in memory at a time.
+    With remove_blank_text the indentation between elements is dropped, see canonical_digest()."""
+    # module also matches the module references inside projects and parameters, hence the parent check
+    for event, element in etree.iterparse(source, events=('end',), tag=['resource', 'module', 'project'],
+                                          huge_tree=True, remove_blank_text=remove_blank_text):
+        parent = element.getparent()
+        if parent is None or parent.tag != element.tag + 's' or parent.getparent().tag != 'buildingblock':
+            continue
+        yield element.tag, element
+        element.clear()
+        # Drop the cleared siblings as well, or the empty shells keep piling up
+        while element.getprevious() is not None:
+            del parent[0]
+
+
+@contextlib.contextmanager
+def without_payload(element):
+    """Takes the embedded file out of a resource element while serializing it, gives the payload or None
+
+    Neither its page nor its digest needs the file, which would be copied along for hundreds of MB."""
+    payload = element.find(resource_payload_tag) if element.tag == 'resource' else None
+    if payload is None:
+        yield None
+        return
+    position = element.index(payload)
+    element.remove(payload)
+    try:
+        yield payload
+    finally:
+        element.insert(position, payload)
+
+
+def iterparse_payloads(source):
+    """Yields (kind, element, payload size) for every complete resource, module and project in source
+
+    Like iterparse_elements(), but the embedded files are counted by a PayloadCounter instead of being
+    held as text, the size is None for resources without one."""
+    counter = PayloadCounter()
+    parser = etree.XMLParser(target=counter, huge_tree=True)
+    for chunk in iter(lambda: source.read(1024 * 1024), b''):
+        parser.feed(chunk)
+        elements, counter.elements = counter.elements, []
+        for kind, element, size in elements:
+            yield kind, element, size
+            parent = element.getparent()
+            element.clear()
+            while element.getprevious() is not None:
+                del parent[0]
+    parser.close()
+
+
+def extract_resources(source, output_folder):
+    """Streams source through a ResourceExtractor and returns the extracted files keyed by resource guid"""
+    extractor = ResourceExtractor(output_folder)
+    parser = etree.XMLParser(target=extractor, huge_tree=True)
+    while not extractor.done:
+        chunk = source.read(1024 * 1024)
+        if not chunk:
+            break
+        parser.feed(chunk)
+    # Once the resources are done the rest of the document is of no interest, and closing a half
+    # fed parser only results in a syntax error
+    if not extractor.done:
+        parser.close()
+    return extractor.extracted
+
+
+def valid_guid(guid):
+    """Returns True if guid is a guid and nothing else, only those go into the name of a file or folder"""
+    return guid is not None and guid_pattern.fullmatch(guid.encode('utf-8')) is not None
+
+
+def crc32_matches(stored, crc32):
+    """Compares a crc32 property, hexadecimal or decimal, to a computed CRC32"""
+    stored = stored.strip()
+    try:
+        if int(stored, 16) == crc32:
+            return True
+    except ValueError:
+        return False
+    return stored.isdigit() and int(stored) == crc32
+
+
+def read_resource_text(path):
+    """Returns the text of an extracted resource file, scripts come in UTF-16 as well as UTF-8"""
+    with open(path, 'rb') as file:
+        data = file.read()
+    if data[:2] in [b'\xff\xfe', b'\xfe\xff']:
+        return data.decode('utf-16', errors='replace')
+    return data.decode('utf-8-sig', errors='replace')
+
+
+def lookup_guid(guid, kind):
+    """Returns the index entry for guid, raises MissingReferenceError if it is not a known kind element"""
+    with profiler.stage('render/lookup'):
+        entry = bbindex.get(guid)
+    if entry is None or entry['kind'] != kind:
+        raise MissingReferenceError("Referenced {} {} not found in Building Block".format(kind, guid))
+    return entry
+
+
+def resource_name(properties, resourcetype):
+    """Returns the display name from a resource properties element"""
+    # This is one of those pesky inconsistencies in RESAM... #FML
+    if resourcetype == 'AMRESOURCEPACKAGE':
+        return properties.find('name').text
+    return properties.find('file').text
+
+
+# Where the *_to_dict functions find their fields, exact paths below each element, see Schema
+common_properties = {
+    'guid': 'properties/guid',
+    'enabled': 'properties/enabled',
+    'description': 'properties/description',
+    'version': 'properties/version',
+    'versioncomment': 'properties/versioncomment'
+}
+folders = {'folders': 'properties/folder/descendant-or-self::folder/name/text()'}
+
+resource_schema = Schema(dict(common_properties, **{
+    'type': 'properties/type',
+    'comment': 'properties/comment',
+    'name': 'properties/name',
+    'file': 'properties/file',
+    'parsefilecontent': 'properties/parsefilecontent',
+    'skipenvironmentvariables': 'properties/skipenvironmentvariables',
+    'crc32': 'properties/crc32',
+    'path': 'properties/path',
+    'urlresource': 'properties/urlresource'
+}), folders)
+
+module_schema = Schema(dict(common_properties, title='properties/name'), dict(folders, **{
+    # The module parameters live in its first, hidden, task
+    'parameters': '(tasks/task/parameters)[1]/*',
+    # we need to grab the non hidden tasks, thanks RES
+    'tasks': 'tasks/task[not(@hidden)]'
+}))
+
+project_schema = Schema(dict(common_properties, title='properties/name'), dict(folders, **{
+    'parameters': 'properties/parameters/*',
+    'modules': 'modules/*'
+}))
+
+projectmodule_schema = Schema({
+    'guid': 'guid',
+    'enabled': 'enabled'
+})
+
+parameter_schema = Schema({
+    'name': 'name',
+    'type': 'type',
+    'value': 'value1',
+    'description': 'description',
+    'on_import': 'inputtiming/importbb',
+    'import_prev': 'inputtiming/importbb/@showprev',
+    'on_schedule': 'inputtiming/schedulejob',
+    'sched_prev': 'inputtiming/schedulejob/@showprev',
+    'sched_erase': 'inputtiming/schedulejob/@eraseprev'
+}, {
+    'links': 'selection/module'
+})
+
+parameterlink_schema = Schema({
+    'targettype': '@type',
+    'targetguid': '@guid',
+    'linktype': '@linktype',
+    'name': 'param'
+})
+
+task_properties = {
+    'guid': 'properties/guid',
+    'enabled': 'properties/enabled'
+}
+task_schema = Schema(task_properties)
+
+task_schemas = {
+    'PWRSHELL': Schema(dict(task_properties, **{
+        'usescript': 'settings/usescript',
+        'source': 'settings/source',
+        'resourcename': 'settings/resourcename',
+        'resourceguid': 'settings/resourceguid'
+    })),
+    'SHUTDOWN': Schema(dict(task_properties, **{
+        'message': 'settings/message',
+        'reboot': 'settings/reboot',
+        'force': 'settings/force',
+        'check4users': 'settings/check4users',
+        'timeout': 'settings/timeout',
+        'messagetext': 'settings/messagetext',
+        'duration': 'settings/duration',
+        'waitforreboot': 'settings/waitforreboot'
+    })),
+    'DOWNLOAD': Schema(dict(task_properties, **{
+        'ysnlog': 'settings/ysnlog',
+        'ysndestination': 'settings/ysndestination',
+        'destination': 'settings/destination',
+        'resources': 'settings/resources'
+    })),
+    'FILEOPERATIONS': Schema(task_properties, {
+        'fileoperationtasks': 'settings/fileoperationtasks/fileoperationtask'
+    }),
+    'REGISTRY': Schema(dict(task_properties, regfile='settings/regfile')),
+    'SECURITY': Schema(dict(task_properties, **{
+        'objecttype': 'settings/objecttype',
+        'filename': 'settings/filename',
+        'replaceacl': 'settings/replaceacl',
+        'propagate': 'settings/propagate'
+    }), {
+        'permissions': 'settings/permissions/permission'
+    }),
+    'COMMAND': Schema(dict(task_properties, **{
+        'commandline': 'settings/commandline',
+        'scriptext': 'settings/scriptext',
+        'usecmd': 'settings/usecmd',
+        'redirect': 'settings/redirect',
+        'failonerroutput': 'settings/failonerroutput',
+        'validateexitcode': 'settings/validateexitcode',
+        'timeout': 'settings/timeout',
+        'terminate': 'settings/terminate',
+        'terminatetree': 'settings/terminatetree',
+        'grablogfile': 'settings/grablogfile',
+        'script': 'settings/script'
+    })),
+    'LINUX_COMMAND': Schema(dict(task_properties, **{
+        'commandline': 'settings/commandline',
+        'scriptext': 'settings/scriptext',
+        'usecmd': 'settings/usecmd',
+        'redirect': 'settings/redirect',
+        'validateexitcode': 'settings/validateexitcode',
+        'timeout': 'settings/timeout',
+        'terminate': 'settings/terminate',
+        'grablogfile': 'settings/grablogfile',
+        'script': 'settings/script'
+    }))
+}
+task_schemas['LINUX_DOWNLOAD'] = task_schemas['DOWNLOAD']
+
+fileoperationtask_schema = Schema({
+    'type': 'type',
+    'sourcelocation': 'sourcelocation',
+    'destinationlocation': 'destinationlocation'
+})
+
+permission_schema = Schema({
+    'action': 'action',
+    'account': 'account',
+    'right': 'permission'
+})
+
+
+def parameter_to_dict(p):
+    """Retruns a dictionary from a param xml element"""
+    fields = parameter_schema.extract(p)
     parameterdict = {
-        'name': p.find('.//name').text,
-        'type': parameter_type.get(p.find('.//type').text, "Unknown"),
-        'value': value,
-        'description': (p.find('.//description')).text,
+        'name': fields['name'],
+        'type': parameter_type.get(fields['type'], "Unknown"),
+        'value': fields['value'] or "",
+        'description': fields['description'],
+        # Input tab
         'input': {
-            'on_import': on_import,
-            'import_prev': import_prev,
-            'on_schedule': on_schedule,
-            'sched_prev': sched_prev,
-            'sched_erase': sched_erase
+            'on_import': fields['on_import'] == 'yes',
+            'import_prev': fields['import_prev'] == 'yes',
+            'on_schedule': fields['on_schedule'] == 'yes',
+            'sched_prev': fields['sched_prev'] == 'yes',
+            # Cannot be sure this exists, but assume False if missing
+            'sched_erase': fields['sched_erase'] == 'yes'
         },
         'links': []
     }
-    if len(p.find('.//selection')) > 0:
-        for module in p.findall('.//selection/module'):
-            # Grab the type and guid to construct a target
-            targettype = module.xpath('.//@type')[0]
-            targetguid = module.xpath('.//@guid')[0]
-            xpath = '//' + targettype + '/properties[guid/text()="' + targetguid + '"]/name'
-            targetname = bbtree.xpath(xpath)[0].text
-
-            # Auto Linked Parameters do not have a link type in the xml
-            # Default is to Set Initial Value
-            try:
-                linktype = module.xpath('.//@linktype')[0]
-            except IndexError:
-                linktype = '0'
-            link = {
-                'targettype': targettype,
-                'targetguid': targetguid,
-                'linktype': linktype_display.get(linktype, 'Error'),
-                'targetname': targetname,
-                'name': module.find('.//param').text
-            }
-            parameterdict['links'].append(link)
+    for module in fields['links']:
+        link = parameterlink_schema.extract(module)
+        # Grab the type and guid to construct a target
+        targetname = lookup_guid(link['targetguid'], link['targettype'])['name']
+
+        # Auto Linked Parameters do not have a link type in the xml
+        # Default is to Set Initial Value
+        link['linktype'] = linktype_display.get(link['linktype'] or '0', 'Error')
+        link['targetname'] = targetname
+        parameterdict['links'].append(link)
 
     return parameterdict
 
 
 def projectmodule_to_dict(p):
     """Returns a dictionary from a module xml as linked from a project"""
-    guid = p.find('.//guid').text
-    xpath = '//modules/module/properties[guid/text()="' + guid + '"]'
-    module_element = bbtree.xpath(xpath)[0]
-    name = module_element.find('.//name').text
-    enabled = p.find('.//enabled').text
-    projectmoduledict = {
-        'guid': guid,
-        'name': name,
-        'enabled': enabled
-    }
+    projectmoduledict = projectmodule_schema.extract(p)
+    projectmoduledict['name'] = lookup_guid(projectmoduledict['guid'], 'module')['name']
     return projectmoduledict
 
 
 def task_to_dict(t):
     """Returns a dictionary from a task xml element"""
-    # Determine type and gather common info
-    tasktype = t.find('.//properties/type').text
+    # Determine type and gather common info, the type's schema has the settings as well
+    tasktype = t.findtext('properties/type')
+    fields = task_schemas.get(tasktype, task_schema).extract(t)
     displayname = task_displayname.get(tasktype, "Unknown (" + tasktype + ")")
     taskdict = {
         'type': tasktype,
         'displayname': displayname,
-        'guid': t.find('.//properties/guid').text,
-        'enabled': t.find('.//properties/enabled').text
+        'guid': fields['guid'],
+        'enabled': fields['enabled']
     }
     # Tasks have type specific properties which need to be dealt with individually
-    # We'll use the 'settings' of the taskdict to store a rendered partial table
-    # based of the type's template. To be included in the main module template.
+    # We'll use the 'settings' of the taskdict to store them and 'template' to name
+    # the type's partial table, which the main module template includes.
     if tasktype == 'PWRSHELL':
         # usescript indicates if the script tab is used. If not, the source code
         # needs to come from a resource. Value is always yes or no.
-        usescript = t.find('.//settings/usescript').text
-        if usescript == 'yes':
+        if fields['usescript'] == 'yes':
             pwrshell = {
                 'source': "Script Tab",
-                'code': t.find('.//settings/source').text
+                'code': cap_blob(taskdict, fields['source'], 'ps1', 'powershell')
             }
         else:
             pwrshell = {
                 'source': "Resource File",
-                'resourcename': t.find('.//settings/resourcename').text,
-                'resourceguid': t.find('.//settings/resourceguid').text,
-                # ToDo grab and base64 decode source from XBB
-                'code': 'To Be Decoded somehow...'
+                'resourcename': fields['resourcename'],
+                'resourceguid': fields['resourceguid'],
+                'code': 'Resource not extracted, see --extract-resources'
             }
-        taskdict['settings'] = env.get_template('PWRSHELL.html').render(pwrshell=pwrshell)
+            payload = bbindex.get(pwrshell['resourceguid'], {}).get('payload')
+            if payload is not None:
+                pwrshell['link'] = '../' + payload['link']
+                if payload['size'] <= inline_limit:
+                    pwrshell['code'] = read_resource_text(payload['path'])
+                else:
+                    pwrshell['code'] = 'Resource too large to show here, follow the link'
+
+        taskdict['settings'] = pwrshell
+        taskdict['template'] = 'PWRSHELL.html'
 
     elif tasktype == 'SHUTDOWN':
-        message = t.find('.//settings/message').text
-        reboot = t.find('.//settings/reboot').text
-        force = t.find('.//settings/force').text
-        check4users = t.find('.//settings/check4users').text
-        timeout = t.find('.//settings/timeout').text
         shutdown = {
-            'message': message,
-            'reboot': reboot,
-            'force': force,
-            'check4users': check4users,
-            'timeout': timeout
+            'message': fields['message'],
+            'reboot': fields['reboot'],
+            'force': fields['force'],
+            'check4users': fields['check4users'],
+            'timeout': fields['timeout']
         }
-        if message == 'yes':
-            messagetext = t.find('.//settings/messagetext').text
-            duration = t.find('.//settings/duration').text
-            shutdown['messagetext'] = messagetext
-            shutdown['duration'] = duration
-        if reboot == 'yes':
-            waitforreboot = t.find('.//settings/waitforreboot').text
-            shutdown['waitforreboot'] = waitforreboot
+        if fields['message'] == 'yes':
+            shutdown['messagetext'] = fields['messagetext']
+            shutdown['duration'] = fields['duration']
+        if fields['reboot'] == 'yes':
+            shutdown['waitforreboot'] = fields['waitforreboot']
 
-        taskdict['settings'] = env.get_template('SHUTDOWN.html').render(shutdown=shutdown)
+        taskdict['settings'] = shutdown
+        taskdict['template'] = 'SHUTDOWN.html'
 
     elif tasktype == 'DOWNLOAD' or tasktype == 'LINUX_DOWNLOAD':
-        ysnlog = t.find('.//settings/ysnlog').text
-        ysndestination = t.find('.//settings/ysndestination').text
         download = {
-            'ysnlog': ysnlog,
-            'ysndestination': ysndestination,
+            'ysnlog': fields['ysnlog'],
+            'ysndestination': fields['ysndestination'],
             'resources': []
         }
-        if ysndestination == 'yes':
-            destination = t.find('.//settings/destination').text
-            download['destination'] = destination
-        resources_string = t.find('.//settings/resources').text
-        for resourceguid in resources_string.split(','):
-            xpath = '//resource[properties/guid="' + resourceguid + '"]'
-            resource_element = bbtree.xpath(xpath)[0]
-            guid = resource_element.find('.//properties/guid').text
-            resourcetype = resource_element.find('.//properties/type').text
-            if resourcetype == 'AMRESOURCEPACKAGE':
-                name = resource_element.find('.//properties/name').text
-            else:
-                name = resource_element.find('.//properties/file').text
+        if fields['ysndestination'] == 'yes':
+            download['destination'] = fields['destination']
+        for resourceguid in fields['resources'].split(','):
+            entry = lookup_guid(resourceguid, 'resource')
             resource = {
-                'guid': guid,
-                'name': name,
-                'type': resourcetype
+                'guid': entry['guid'],
+                'name': entry['name'],
+                'type': entry['type']
             }
 
             download['resources'].append(resource)
 
-        taskdict['settings'] = env.get_template('DOWNLOAD.html').render(download=download)
+        taskdict['settings'] = download
+        taskdict['template'] = 'DOWNLOAD.html'
 
     elif tasktype == 'FILEOPERATIONS':
         fileoperationtasks = []
-        for task_element in t.findall('.//fileoperationtask'):
+        for task_element in fields['fileoperationtasks']:
+            operation = fileoperationtask_schema.extract(task_element)
             fileoperationtask = {
-                'type': task_element.find('.//type').text,
-                'sourcelocation': task_element.find('.//sourcelocation').text,
+                'type': operation['type'],
+                'sourcelocation': operation['sourcelocation'],
                 'hasdestination': False
             }
             if fileoperationtask['type'] in ['copy', 'move', 'rename']:
                 fileoperationtask['hasdestination'] = True
-                fileoperationtask['destinationlocation'] = task_element.find('.//destinationlocation').text
+                fileoperationtask['destinationlocation'] = operation['destinationlocation']
             # ToDo add support for ini file manipulation
             fileoperationtasks.append(fileoperationtask)
 
-        taskdict['settings'] = env.get_template('FILEOPERATIONS.html').render(fileoperationtasks=fileoperationtasks)
+        taskdict['settings'] = fileoperationtasks
+        taskdict['template'] = 'FILEOPERATIONS.html'
 
     elif tasktype == 'REGISTRY':
-        registryfile = unreszlib(t.find('.//regfile').text)
+        try:
+            registryfile = cap_blob(taskdict, unreszlib(fields['regfile']), 'reg', 'registry', fields['regfile'])
+        except (ValueError, zlib.error) as err:
+            registryfile = 'Registry file could not be decoded: {}'.format(err)
 
-        taskdict['settings'] = env.get_template('REGISTRY.html').render(registryfile=registryfile)
+        taskdict['settings'] = registryfile
+        taskdict['template'] = 'REGISTRY.html'
 
     elif tasktype == 'SECURITY':
 
         permission = {
-            'objecttype': security_objecttype[t.find('.//objecttype').text],
-            'filename': t.find('.//filename').text,
-            'replaceacl': t.find('.//replaceacl').text,
-            'propagate': t.find('.//propagate').text,
+            'objecttype': security_objecttype[fields['objecttype']],
+            'filename': fields['filename'],
+            'replaceacl': fields['replaceacl'],
+            'propagate': fields['propagate'],
             'permissions': []
         }
         # Special case for nicer display of task type
         taskdict['displayname'] = permission['objecttype']
-        for permission_element in t.findall('.//permissions/permission'):
+        for permission_element in fields['permissions']:
+            item = permission_schema.extract(permission_element)
             permission_item = {
-                'action': permission_action[permission_element.find('.//action').text],
-                'account': permission_element.find('.//account').text,
-                'right': access_mask[permission_element.find('.//permission').text]
+                'action': permission_action[item['action']],
+                'account': item['account'],
+                'right': access_mask[item['right']]
             }
             permission['permissions'].append(permission_item)
 
-        taskdict['settings'] = env.get_template('SECURITY.html').render(permission=permission)
+        taskdict['settings'] = permission
+        taskdict['template'] = 'SECURITY.html'
 
     elif tasktype == 'COMMAND':
-        commandline = t.find('.//commandline').text
+        commandline = fields['commandline']
         # If the script is not referenced in the commandline it is ignored, so will we.
         hasscripttab = '@[SCRIPT]' in commandline.upper()
-        scriptext = t.find('.//scriptext').text
-        lexer = fileext_lexer.get(scriptext, 'none')
+        lexer = fileext_lexer.get(fields['scriptext'], 'none')
         command = {
             'commandline': commandline,
             'hasscripttab': hasscripttab,
-            'usecmd': t.find('.//usecmd').text,
-            'redirect': t.find('.//redirect').text,
-            'failonerroutput': t.find('.//failonerroutput').text,
-            'validateexitcode': t.find('.//validateexitcode').text,
-            'timeout': t.find('.//timeout').text,
-            'terminate': t.find('.//terminate').text,
-            'terminatetree': t.find('.//terminatetree').text,
-            'grablog': t.find('.//grablogfile').text,
-            'script': t.find('.//script').text,
+            'usecmd': fields['usecmd'],
+            'redirect': fields['redirect'],
+            'failonerroutput': fields['failonerroutput'],
+            'validateexitcode': fields['validateexitcode'],
+            'timeout': fields['timeout'],
+            'terminate': fields['terminate'],
+            'terminatetree': fields['terminatetree'],
+            'grablog': fields['grablogfile'],
+            'script': cap_blob(taskdict, fields['script'], fields['scriptext'], 'winbatch') if hasscripttab
+            else fields['script'],
             'lexer': lexer
         }
 
-        taskdict['settings'] = env.get_template('COMMAND.html').render(command=command)
+        taskdict['settings'] = command
+        taskdict['template'] = 'COMMAND.html'
 
     elif tasktype == 'LINUX_COMMAND':
-        commandline = t.find('.//commandline').text
+        commandline = fields['commandline']
         # If the script is not referenced in the commandline it is ignored, so will we.
         hasscripttab = '@[SCRIPT]' in commandline.upper()
-        scriptext = t.find('.//scriptext').text
-        lexer = fileext_lexer.get(scriptext, 'none')
+        lexer = fileext_lexer.get(fields['scriptext'], 'none')
         command = {
             'commandline': commandline,
             'hasscripttab': hasscripttab,
-            'usecmd': t.find('.//usecmd').text,
-            'redirect': t.find('.//redirect').text,
-            'validateexitcode': t.find('.//validateexitcode').text,
-            'timeout': t.find('.//timeout').text,
-            'terminate': t.find('.//terminate').text,
-            'grablog': t.find('.//grablogfile').text,
-            'script': t.find('.//script').text,
+            'usecmd': fields['usecmd'],
+            'redirect': fields['redirect'],
+            'validateexitcode': fields['validateexitcode'],
+            'timeout': fields['timeout'],
+            'terminate': fields['terminate'],
+            'grablog': fields['grablogfile'],
+            'script': cap_blob(taskdict, fields['script'], fields['scriptext'], 'bash') if hasscripttab
+            else fields['script'],
             'lexer': lexer
         }
 
-        taskdict['settings'] = env.get_template('LINUX_COMMAND.html').render(command=command)
+        taskdict['settings'] = command
+        taskdict['template'] = 'LINUX_COMMAND.html'
 
     # Finally we return the dictionary to the caller.
     return taskdict
 
 
+def cap_blob(taskdict, text, extension, lexer, stored=None):
+    """Returns text if it is within inline_limit and no other task has it, otherwise just its start for the page
+
+    The whole text goes in the blob of the task, written once per run under the hash of the stored
+    script by script_files(), however many modules have it. Beyond inline_limit as plain text, else
+    highlighted on a page of its own. The module page shows the start and links to it."""
+    if text is None:
+        return text
+    digest = script_digest(text if stored is None else stored)
+    shared = len(bbscripts.get(digest, ()))
+    lines = len(text.splitlines())
+    small = lines <= blob_preview_lines and len(text) <= blob_preview_size
+    if len(text) <= inline_limit and (shared < 2 or small):
+        return text
+    preview = '\n'.join(text[:blob_preview_size].splitlines()[:blob_preview_lines])
+    # The extension comes from the export, anything but a plain word could lead out of scripts/
+    if extension is None or extension_pattern.fullmatch(extension) is None:
+        extension = 'txt'
+    taskdict['blob'] = {
+        # Too large ones are plain text, browsers show that instead of offering to run it
+        'link': digest + ('.html' if len(text) <= inline_limit else '.{}.txt'.format(extension)),
+        'digest': digest,
+        'lexer': lexer,
+        'shared': shared,
+        'size': len(text.encode('utf-8')),
+        'lines': lines,
+        'preview': preview.count('\n') + 1,
+        'text': text
+    }
+    return preview
+
+
 def create_resource_page(r):
+    """Creates a html from jinja template and a resource element"""
+    resource = resource_to_dict(r)
+    return render_page('resource', resource), resource['guid']
+
+
+def create_module_page(m):
     """Creates a html from jinja template and a module element"""
-    guid = r.find('.//properties/guid').text
-    resourcetype = r.find('.//properties/type').text
-    folderpath = '/'.join([f.text for f in r.findall('.//folder/name')])
+    module = module_to_dict(m)
+    return render_page('module', module), module['guid']
+
+
+def create_project_page(p):
+    """Creates a html from jinja template and a project element"""
+    project = project_to_dict(p)
+    return render_page('project', project), project['guid']
+
+
+def render_page(kind, page):
+    """Renders the model object or dictionary of a resource, module, project or script with the template of
+    its kind"""
+    with profiler.stage('render/jinja'):
+        template = environment().get_template(kind + '.html')
+        return template.render({kind: page})
+
+
+def resource_to_dict(r):
+    """Returns a dictionary from a resource xml element"""
+    fields = resource_schema.extract(r)
+    guid = fields['guid']
+    resourcetype = fields['type']
     resource = {
         'guid': guid,
         'displayname': resourcetype_displayname[resourcetype],
-        'version': r.find('.//properties/version').text,
-        'versioncomment': r.find('.//properties/versioncomment').text,
+        'version': fields['version'],
+        'versioncomment': fields['versioncomment'],
         'type': resourcetype,
-        'folderpath': folderpath,
-        'enabled': r.find('.//properties/enabled').text,
-        'comment': r.find('.//properties/comment').text
+        'folderpath': '/'.join(fields['folders']),
+        'enabled': fields['enabled'],
+        'comment': fields['comment']
     }
     # Here we add the resource type specific attributes
     if resourcetype == 'DATABASE':
-        resource['name'] = r.find('.//properties/file').text
-        resource['parsefilecontent'] = r.find('.//properties/parsefilecontent').text
-        resource['skipenvironmentvariables'] = r.find('.//properties/skipenvironmentvariables').text
-        resource['crc32'] = r.find('.//properties/crc32').text
+        resource['name'] = fields['file']
+        resource['parsefilecontent'] = fields['parsefilecontent']
+        resource['skipenvironmentvariables'] = fields['skipenvironmentvariables']
+        resource['crc32'] = fields['crc32']
     elif resourcetype == 'FILESHARE':
-        resource['name'] = r.find('.//properties/file').text
-        resource['path'] = r.find('.//properties/path').text
+        resource['name'] = fields['file']
+        resource['path'] = fields['path']
     elif resourcetype == 'AMRESOURCEPACKAGE':
-        resource['name'] = r.find('.//properties/name').text
-        resource['crc32'] = r.find('.//properties/crc32').text
+        resource['name'] = fields['name']
+        resource['crc32'] = fields['crc32']
     elif resourcetype == 'URLRESOURCE':
-        resource['name'] = r.find('.//properties/file').text
-        resource['urlresource'] = r.find('.//properties/urlresource').text
-
-    template = env.get_template('resource.html')
-    html = template.render(resource=resource)
-    return html, resource['guid']
+        resource['name'] = fields['file']
+        resource['urlresource'] = fields['urlresource']
+    # Only there if the embedded file was extracted
+    resource['payload'] = bbindex.get(guid, {}).get('payload')
+    resource['usedby'] = used_by(guid)
+    return resource
 
 
-def create_module_page(m):
-    """Creates a html from jinja template and a module element"""
-    folderpath = '/'.join([f.text for f in m.findall('.//folder/name')])
-    paramroot = m.find('.//tasks/task/parameters')
-    # we need to grab the non hidden tasks, thanks RES
-    actual_tasks = m.xpath('.//tasks/task[not(@hidden)]')
+def module_to_dict(m):
+    """Returns a dictionary from a module xml element, including its parameters and tasks"""
+    fields = module_schema.extract(m)
     module = {
-        'title': (m.find('.//name')).text,
-        'guid': (m.find('.//guid')).text,
-        'enabled': (m.find('.//enabled')).text,
-        'description': (m.find('.//description')).text,
-        'version': (m.find('.//version')).text,
-        'versioncomment': (m.find('.//versioncomment')).text,
-        'folderpath': folderpath,
+        'title': fields['title'],
+        'guid': fields['guid'],
+        'enabled': fields['enabled'],
+        'description': fields['description'],
+        'version': fields['version'],
+        'versioncomment': fields['versioncomment'],
+        'folderpath': '/'.join(fields['folders']),
         'parameters': [],
         'tasks': []
     }
-    if len(paramroot) > 0:
-        for element in paramroot.getchildren():
-            module['parameters'].append(parameter_to_dict(element))
-        module['parameters'] = sorted(module['parameters'], key=lambda k: k['name'])
-    for task in actual_tasks:
-        module['tasks'].append(task_to_dict(task))
-
-    template = env.get_template('module.html')
-    html = template.render(module=module)
-    return html, module['guid']
-
-
-def create_project_page(p):
-    folderpath = '/'.join([f.text for f in p.findall('.//folder/name')])
-    paramroot = p.find('.//properties/parameters')
-    moduleroot = p.find('.//modules')
+    for element in fields['parameters']:
+        module['parameters'].append(parameter_to_dict(element))
+    module['parameters'] = sorted(module['parameters'], key=lambda k: k['name'])
+    for task in fields['tasks']:
+        start = time.perf_counter()
+        taskdict = task_to_dict(task)
+        if profiler.enabled:
+            profiler.add_task(taskdict['type'], time.perf_counter() - start)
+        module['tasks'].append(taskdict)
+    module['usedby'] = used_by(module['guid'])
+    return module
+
+
+def project_to_dict(p):
+    """Returns a dictionary from a project xml element, including its parameters and modules"""
+    fields = project_schema.extract(p)
     project = {
-        'title': (p.find('.//name')).text,
-        'guid': (p.find('.//guid')).text,
-        'enabled': (p.find('.//enabled')).text,
-        'description': (p.find('.//description')).text,
-        'version': (p.find('.//version')).text,
-        'versioncomment': (p.find('.//versioncomment')).text,
-        'folderpath': folderpath,
+        'title': fields['title'],
+        'guid': fields['guid'],
+        'enabled': fields['enabled'],
+        'description': fields['description'],
+        'version': fields['version'],
+        'versioncomment': fields['versioncomment'],
+        'folderpath': '/'.join(fields['folders']),
         'parameters': [],
         'modules': []
     }
 
-    if len(paramroot) > 0:
-        for element in paramroot.getchildren():
-            project['parameters'].append(parameter_to_dict(element))
-        project['parameters'] = sorted(project['parameters'], key=lambda k: k['name'])
-    if len(moduleroot) > 0:
-        for module in moduleroot.getchildren():
-            project['modules'].append(projectmodule_to_dict(module))
+    for element in fields['parameters']:
+        project['parameters'].append(parameter_to_dict(element))
+    project['parameters'] = sorted(project['parameters'], key=lambda k: k['name'])
+    for module in fields['modules']:
+        project['modules'].append(projectmodule_to_dict(module))
+    project['usedby'] = used_by(project['guid'])
+    return project
 
-    template = env.get_template('project.html')
-    html = template.render(project=project)
-    return html, project['guid']
+
+# The dictionary function for each kind of top level element, used by write_page()
+page_dicts = {
+    'resource': resource_to_dict,
+    'module': module_to_dict,
+    'project': project_to_dict
+}
+
+# And the model class their dictionaries become, see page_model()
+page_models = {
+    'resource': Resource,
+    'module': Module,
+    'project': Project
+}
 
 
 def unreszlib(reszlib):
-    """Helper function to extract text from RESZLIB values"""
-    return zlib.decompress(binascii.unhexlify(reszlib[22:])).decode("utf-8")
+    """Helper function to extract text from RESZLIB values
+
+    Decompression stops at reszlib_limit, a value expanding beyond it raises ValueError instead of
+    taking all memory. So do truncated and malformed values, or zlib.error."""
+    decompressor = zlib.decompressobj()
+    data = decompressor.decompress(binascii.unhexlify(reszlib[22:]), reszlib_limit + 1)
+    if len(data) > reszlib_limit or decompressor.unconsumed_tail:
+        raise ValueError("RESZLIB value expands beyond {} bytes".format(reszlib_limit))
+    # zlib.decompress() would complain about a cut off stream, the decompressor just returns what it has
+    if not decompressor.eof:
+        raise ValueError("RESZLIB value is truncated")
+    return data.decode("utf-8")
 
 
 def main():
     """Main function, checks for arguments and default files."""
+    global inline_limit
     parser = argparse.ArgumentParser()
     parser.add_argument('-f', '--file',
                         default='./Export.xml',
                         metavar='<BuildingBlock>',
-                        help='The Building Block XML File to process')
+                        help='The Building Block XML File to process, may be compressed (.gz, .bz2, .xz or a .zip '
+                             'holding it) or - for stdin')
+
+    parser.add_argument('-b', '--batch',
+                        metavar='<folder|glob>',
+                        help='Process every Building Block in a folder (.xml, compressed or zipped) or matching a '
+                             'glob, instead of --file')
 
     parser.add_argument('-o', '--output',
                         default='./output',
                         metavar='<folder>,',
                         help='The folder will be deleted if it exists!')
+
+    parser.add_argument('-a', '--archive',
+                        metavar='<file>',
+                        help='Write the report into this zip or tar file (.tar, .tar.gz, .tgz, .tar.bz2, .tar.xz) '
+                             'instead of the output folder')
+
+    parser.add_argument('--gzip',
+                        action='store_true',
+                        help='Write a compressed .gz copy next to every page, script and stylesheet, '
+                             'for web servers serving them as they are')
+
+    parser.add_argument('--brotli',
+                        action='store_true',
+                        help='The same with .br copies, needs the brotli package')
+
+    parser.add_argument('--stats',
+                        action='store_true',
+                        help='Print the number of elements and tasks per type, the embedded file sizes and the '
+                             'largest scripts of --file or --batch, without writing a report')
+
+    parser.add_argument('--list',
+                        action='store_true',
+                        help='Print the kind, guid and name of every element of --file or --batch, tab separated')
+
+    parser.add_argument('-d', '--diff',
+                        metavar='<BuildingBlock>',
+                        help='Compare --file against this previous export and write diff.html '
+                             'instead of the report')
+
+    parser.add_argument('--serve',
+                        type=int,
+                        nargs='?',
+                        const=8000,
+                        metavar='PORT',
+                        help='Serve the report of --file on localhost (default port 8000), '
+                             'rendering pages on request')
+
+    parser.add_argument('--page-cache-size',
+                        type=int,
+                        default=64,
+                        metavar='MB',
+                        help='Maximum size of the rendered pages kept in memory by --serve (default 64)')
+
+    parser.add_argument('-s', '--stream',
+                        action='store_true',
+                        help='Stream the Building Block instead of loading it whole, for very large exports')
+
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=1,
+                        metavar='N',
+                        help='Render pages in N processes, 0 uses all CPU cores')
+
+    parser.add_argument('-w', '--writers',
+                        type=int,
+                        default=4,
+                        metavar='N',
+                        help='Write the output files from N threads while rendering goes on, 0 writes them in turn '
+                             '(default 4)')
+
+    parser.add_argument('-i', '--incremental',
+                        action='store_true',
+                        help='Keep the output folder and only rewrite pages that changed since the last run')
+
+    parser.add_argument('-x', '--extract-resources',
+                        action='store_true',
+                        help='Write embedded resource files to resources/<guid>/ and verify their CRC32')
+
+    parser.add_argument('--inline-limit',
+                        type=int,
+                        default=256,
+                        metavar='KB',
+                        help='Scripts and registry files larger than this get a file of their own, '
+                             'the page shows the start (default 256)')
+
+    parser.add_argument('-n', '--ndjson',
+                        action='store_true',
+                        help='Write every resource, module and project as a line of json to model.ndjson, '
+                             'with the same data as the pages')
+
+    parser.add_argument('--no-html',
+                        action='store_true',
+                        help='Skip the pages, search and index, with --ndjson for just the data')
+
+    parser.add_argument('--no-search',
+                        action='store_true',
+                        help='Skip the search index and page')
+
+    parser.add_argument('--highlight-cache',
+                        metavar='<folder>',
+                        help='Keep highlighted scripts in this folder between runs')
+
+    parser.add_argument('--highlight-cache-size',
+                        type=int,
+                        default=256,
+                        metavar='MB',
+                        help='Maximum size of the highlight cache folder (default 256)')
+
+    parser.add_argument('--model-cache',
+                        metavar='<folder>',
+                        help='Keep the parsed model of every export in this folder, '
+                             're-runs on an unchanged export skip the parse')
+
+    parser.add_argument('--profile',
+                        action='store_true',
+                        help='Print the time spent per stage, task type and page and write it to profile.json')
+
+    parser.add_argument('--cprofile',
+                        metavar='<file>',
+                        help='Dump cProfile statistics of the run to this file, for pstats or snakeviz')
     args = parser.parse_args()
+    if args.brotli and brotli is None:
+        parser.error('--brotli needs the brotli package')
+    if args.archive and (args.serve or args.incremental or args.extract_resources or args.ndjson):
+        parser.error('--archive does not go with --serve, --incremental, --extract-resources or --ndjson')
+    if args.no_html and args.incremental:
+        parser.error('--no-html does not go with --incremental')
+    # Stdin is read once, these go back to the start or need a file to stat
+    if args.file == '-' and (args.serve or args.stream or args.extract_resources or args.model_cache):
+        parser.error('--file - does not go with --serve, --stream, --extract-resources or --model-cache')
+    if args.diff == '-':
+        parser.error('--diff reads the previous export twice, it needs a file')
     buildingblock = args.file
     output_folder = args.output
-    process_buildingblock(buildingblock, output_folder)
+    if args.stats or args.list:
+        try:
+            for bb in batch_files(args.batch) if args.batch else [buildingblock]:
+                if args.list:
+                    list_buildingblock(bb, show_file=args.batch is not None)
+                else:
+                    stats_buildingblock(bb)
+        except BrokenPipeError:
+            # Piped into head or the like, which has seen enough. Keep the exit from complaining about stdout.
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return
+    jobs = args.jobs or os.cpu_count()
+    if args.highlight_cache:
+        highlight_cache.open(args.highlight_cache, args.highlight_cache_size * 1024 * 1024)
+    if args.model_cache:
+        model_cache.open(args.model_cache)
+    inline_limit = args.inline_limit * 1024
+    output_writer.threads = args.writers
+    output_writer.suffixes = [suffix for suffix, enabled in [('.gz', args.gzip), ('.br', args.brotli)] if enabled]
+    if args.archive:
+        output_writer.open_archive(args.archive, output_folder)
+    profiler.enabled = args.profile
+    search_index.enabled = not args.no_search
+    start = time.perf_counter()
+    if args.cprofile:
+        deep_profiler = cProfile.Profile()
+        deep_profiler.enable()
+    if args.serve:
+        serve_buildingblock(buildingblock, args.serve, args.page_cache_size * 1024 * 1024)
+    elif args.diff:
+        diff_buildingblocks(args.diff, buildingblock, output_folder)
+    elif args.batch:
+        process_batch(args.batch, output_folder, jobs=jobs, stream=args.stream, incremental=args.incremental,
+                      extract=args.extract_resources, ndjson=args.ndjson, render=not args.no_html)
+    else:
+        process_buildingblock(buildingblock, output_folder, stream=args.stream, jobs=jobs,
+                              incremental=args.incremental, extract=args.extract_resources, ndjson=args.ndjson,
+                              render=not args.no_html)
+    if args.cprofile:
+        deep_profiler.disable()
+        deep_profiler.dump_stats(args.cprofile)
+    highlight_cache.prune()
+    print("Highlight cache: {} hits, {} misses".format(highlight_cache.hits, highlight_cache.misses))
+    if output_writer.files:
+        print(output_writer.summary(time.perf_counter() - start))
+    if args.profile and (output_writer.archive is not None or os.path.isdir(output_folder)):
+        print(profiler.summary())
+        output_writer.write(output_folder + '/profile.json', json.dumps(profiler.report(), indent=1))
+    output_writer.close_archive()
 
 if __name__ == "__main__":
     # execute only if run as a script
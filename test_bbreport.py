@@ -0,0 +1,330 @@
+"""Regression tests for bbreport.py on Building Blocks made by bbgenerate.py
+
+Run with: python -m pytest -q"""
+
+import bz2
+import filecmp
+import gzip
+import json
+import lzma
+import os
+import re
+import subprocess
+import sys
+import tarfile
+import zipfile
+import zlib
+
+import pytest
+
+import bbgenerate
+import bbreport
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def write_buildingblock(path, tree):
+    tree.write(str(path), encoding='utf-8', xml_declaration=True)
+    return str(path)
+
+
+def rename_module(tree, index, name):
+    """Renames the module at index in place and returns its guid"""
+    module = tree.getroot().findall('buildingblock/modules/module')[index]
+    module.find('properties/name').text = name
+    return module.findtext('properties/guid')
+
+
+def run_bbreport(*args, stdin=None):
+    """Runs bbreport.py with args, reading stdin from this file if given, and returns what it printed
+
+    A traceback fails the test by the exit code."""
+    with open(stdin, 'rb') if stdin else open(os.devnull, 'rb') as source:
+        result = subprocess.run([sys.executable, os.path.join(here, 'bbreport.py')] + [str(arg) for arg in args],
+                                check=True, stdin=source, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return result.stdout.decode('utf-8')
+
+
+def differences(left, right, ignore=()):
+    """Returns the relative paths that are missing on one side or differ between two output folders"""
+    comparison = filecmp.dircmp(left, right, ignore=list(ignore))
+    result = comparison.left_only + comparison.right_only + comparison.funny_files
+    # dircmp compares by stat only, the pages must match byte for byte
+    match, mismatch, errors = filecmp.cmpfiles(left, right, comparison.common_files, shallow=False)
+    result += mismatch + errors
+    for name in comparison.common_dirs:
+        result += [name + '/' + path
+                   for path in differences(os.path.join(left, name), os.path.join(right, name), ignore)]
+    return sorted(result)
+
+
+@pytest.fixture(scope='module')
+def buildingblock(tmp_path_factory):
+    folder = tmp_path_factory.mktemp('bb')
+    return write_buildingblock(folder / 'bb.xml', bbgenerate.generate_buildingblock(20, 5))
+
+
+@pytest.fixture(scope='module')
+def serial(buildingblock, tmp_path_factory):
+    output = tmp_path_factory.mktemp('serial')
+    run_bbreport('-f', buildingblock, '-o', output)
+    return output
+
+
+@pytest.mark.parametrize('options', [
+    ['-j', 2],
+    ['--stream'],
+    ['--stream', '-j', 2],
+], ids=lambda options: ' '.join(str(option) for option in options))
+def test_output_modes(buildingblock, serial, tmp_path, options):
+    output = tmp_path / 'out'
+    run_bbreport('-f', buildingblock, '-o', output, *options)
+    assert differences(serial, output) == []
+
+
+def test_model_cache(buildingblock, serial, tmp_path):
+    cache = tmp_path / 'cache'
+    for run in ['cold', 'warm']:
+        output = tmp_path / run
+        run_bbreport('-f', buildingblock, '-o', output, '--model-cache', cache)
+        assert differences(serial, output) == [], run
+    assert os.listdir(cache)
+
+
+def test_incremental_rename(tmp_path):
+    tree = bbgenerate.generate_buildingblock(20, 5)
+    buildingblock = write_buildingblock(tmp_path / 'bb.xml', tree)
+    incremental = tmp_path / 'incremental'
+    run_bbreport('-f', buildingblock, '-o', incremental, '-i')
+
+    rename_module(tree, 3, 'Renamed module')
+    write_buildingblock(buildingblock, tree)
+    run_bbreport('-f', buildingblock, '-o', incremental, '-i')
+
+    full = tmp_path / 'full'
+    run_bbreport('-f', buildingblock, '-o', full)
+    # The manifest only exists in incremental output
+    assert differences(full, incremental, ignore=['manifest.json']) == []
+
+
+def test_incremental_write_error(tmp_path):
+    tree = bbgenerate.generate_buildingblock(20, 5)
+    buildingblock = write_buildingblock(tmp_path / 'bb.xml', tree)
+    incremental = tmp_path / 'incremental'
+    run_bbreport('-f', buildingblock, '-o', incremental, '-i')
+    with open(str(incremental / 'manifest.json'), 'rb') as file:
+        manifest = file.read()
+
+    guid = rename_module(tree, 3, 'Renamed module')
+    write_buildingblock(buildingblock, tree)
+    # The changed page can't be written while a folder is in its place
+    page = incremental / 'modules' / (guid + '.html')
+    os.remove(str(page))
+    os.mkdir(str(page))
+    assert 'Error writing' in run_bbreport('-f', buildingblock, '-o', incremental, '-i')
+    with open(str(incremental / 'manifest.json'), 'rb') as file:
+        assert file.read() == manifest
+
+    os.rmdir(str(page))
+    run_bbreport('-f', buildingblock, '-o', incremental, '-i')
+    full = tmp_path / 'full'
+    run_bbreport('-f', buildingblock, '-o', full)
+    assert differences(full, incremental, ignore=['manifest.json']) == []
+
+
+def test_diff_rename(tmp_path):
+    tree = bbgenerate.generate_buildingblock(20, 5)
+    old = write_buildingblock(tmp_path / 'old.xml', tree)
+    guid = rename_module(tree, 3, 'Renamed module')
+    new = write_buildingblock(tmp_path / 'new.xml', tree)
+
+    output = tmp_path / 'diff'
+    run_bbreport('-d', old, '-f', new, '-o', output)
+    with open(os.path.join(str(output), 'diff.json'), 'rt', encoding='utf-8') as file:
+        report = json.load(file)
+
+    assert report['added'] == []
+    assert report['removed'] == []
+    assert len(report['changed']) == 1
+    entry = report['changed'][0]
+    assert (entry['kind'], entry['guid'], entry['name'], entry['oldname']) == \
+        ('module', guid, 'Renamed module', 'Module 00003')
+    assert [change['path'] for change in entry['changes']] == ['properties/name']
+
+
+def test_script_extension_stays_in_output(tmp_path):
+    tree = bbgenerate.generate_buildingblock(5, 5)
+    task = tree.getroot().xpath('//task[properties/type="COMMAND"]')[0]
+    settings = task.find('settings')
+    settings.find('commandline').text = '@[SCRIPT]'
+    # Lands in tmp_path next to the output folder unless the extension is checked
+    settings.find('scriptext').text = '/../../../escaped'
+    settings.find('script').text = 'echo large\n' * 1024
+    buildingblock = write_buildingblock(tmp_path / 'bb.xml', tree)
+
+    output = tmp_path / 'out'
+    run_bbreport('-f', buildingblock, '-o', output, '--inline-limit', 1)
+    assert sorted(os.listdir(str(tmp_path))) == ['bb.xml', 'out']
+    scripts = os.listdir(str(output / 'scripts'))
+    assert all(re.fullmatch(r'[0-9a-f]{40}\.(html|\w+\.txt)', name) for name in scripts)
+    assert any(name.endswith('.txt.txt') for name in scripts)
+
+
+def test_diff_truncated(tmp_path):
+    old = write_buildingblock(tmp_path / 'old.xml', bbgenerate.generate_buildingblock(5, 5))
+    with open(old, 'rb') as file:
+        data = file.read()
+    new = str(tmp_path / 'new.xml')
+    with open(new, 'wb') as file:
+        file.write(data[:len(data) // 2])
+    assert 'Error comparing' in run_bbreport('-d', old, '-f', new, '-o', tmp_path / 'diff')
+
+
+def test_stats_task_types(buildingblock):
+    stats = bbreport.stats_buildingblock(buildingblock)
+    assert stats['kinds'] == {'resource': 2, 'module': 20, 'project': 2}
+    # Without the hidden task holding the module parameters
+    assert sum(stats['tasks'].values()) == 20 * 5
+    assert 'PARAMETERS' not in stats['tasks']
+
+
+@pytest.mark.parametrize('name', ['..', '.', 'C:\\Packages\\..', ''])
+def test_extract_resource_name(tmp_path, name):
+    tree = bbgenerate.generate_buildingblock(5, 5, resources=1)
+    resource = tree.getroot().find('buildingblock/resources/resource')
+    resource.find('properties/file').text = name
+    guid = resource.findtext('properties/guid')
+    buildingblock = write_buildingblock(tmp_path / 'bb.xml', tree)
+
+    with open(buildingblock, 'rb') as source:
+        extracted = bbreport.extract_resources(source, str(tmp_path))
+    assert extracted[guid]['link'] == 'resources/' + guid + '/payload'
+    assert extracted[guid]['verified'] is True
+    assert os.path.isfile(extracted[guid]['path'])
+
+
+@pytest.mark.parametrize('stored, crc32, matches', [
+    ('0000ABCD', 0xABCD, True),
+    ('abcd', 0xABCD, True),
+    (' 0000ABCD\n', 0xABCD, True),
+    ('43981', 43981, True),
+    ('0000ABCE', 0xABCD, False),
+    ('43982', 43981, False),
+    ('', 0, False),
+    ('not a crc', 0, False)
+])
+def test_crc32_matches(stored, crc32, matches):
+    assert bbreport.crc32_matches(stored, crc32) is matches
+
+
+def test_extract_crc32_mismatch(tmp_path, capsys):
+    tree = bbgenerate.generate_buildingblock(5, 5, resources=1)
+    resource = tree.getroot().find('buildingblock/resources/resource')
+    resource.find('properties/crc32').text = '00000000'
+    guid = resource.findtext('properties/guid')
+    buildingblock = write_buildingblock(tmp_path / 'bb.xml', tree)
+
+    with open(buildingblock, 'rb') as source:
+        extracted = bbreport.extract_resources(source, str(tmp_path))
+    assert extracted[guid]['verified'] is False
+    assert 'CRC32 mismatch' in capsys.readouterr().out
+
+
+def test_unreszlib():
+    text = 'Windows Registry Editor Version 5.00\r\n\r\n[HKEY_LOCAL_MACHINE\\Software\\Contoso]\r\n'
+    assert bbreport.unreszlib(bbgenerate.reszlib(text)) == text
+
+
+def test_unreszlib_limit(monkeypatch):
+    monkeypatch.setattr(bbreport, 'reszlib_limit', 1024)
+    assert len(bbreport.unreszlib(bbgenerate.reszlib('x' * 1024))) == 1024
+    with pytest.raises(ValueError, match='expands beyond'):
+        bbreport.unreszlib(bbgenerate.reszlib('x' * 1025))
+
+
+@pytest.mark.parametrize('cut', [2, 10, 40])
+def test_unreszlib_truncated(cut):
+    value = bbgenerate.reszlib('HKEY_LOCAL_MACHINE\\Software\\Contoso ' * 100)
+    with pytest.raises((ValueError, zlib.error)):
+        bbreport.unreszlib(value[:-cut])
+
+
+@pytest.mark.parametrize('archive', ['report.zip', 'report.tar', 'report.tar.gz'])
+def test_archive(buildingblock, serial, tmp_path, archive):
+    output = tmp_path / 'out'
+    run_bbreport('-f', buildingblock, '-o', output, '-a', tmp_path / archive)
+    assert not os.path.exists(str(output))
+    if archive.endswith('.zip'):
+        with zipfile.ZipFile(str(tmp_path / archive)) as file:
+            members = {name: file.read(name) for name in file.namelist()}
+    else:
+        with tarfile.open(str(tmp_path / archive)) as file:
+            members = {member.name: file.extractfile(member).read() for member in file if member.isfile()}
+    files = {}
+    for folder, subfolders, names in os.walk(str(serial)):
+        for name in names:
+            path = os.path.join(folder, name)
+            with open(path, 'rb') as file:
+                files[os.path.relpath(path, str(serial)).replace(os.sep, '/')] = file.read()
+    assert members == files
+
+
+def test_gzip_copies(buildingblock, serial, tmp_path):
+    output = tmp_path / 'out'
+    run_bbreport('-f', buildingblock, '-o', output, '--gzip')
+    copies = []
+    for folder, subfolders, names in os.walk(str(output)):
+        for name in names:
+            if name.endswith('.gz'):
+                copies.append(name)
+                with gzip.open(os.path.join(folder, name), 'rb') as copy, \
+                        open(os.path.join(folder, name[:-3]), 'rb') as original:
+                    assert copy.read() == original.read()
+            elif name.endswith(bbreport.compressible_extensions):
+                assert os.path.exists(os.path.join(folder, name + '.gz'))
+    assert any(name.endswith('.html.gz') for name in copies)
+    # Apart from the copies the same report
+    assert differences(serial, output, ignore=copies) == []
+
+
+def test_list(buildingblock):
+    lines = run_bbreport('--list', '-f', buildingblock).splitlines()
+    assert len(lines) == 2 + 20 + 2
+    assert sorted(set(line.split('\t')[0] for line in lines)) == ['module', 'project', 'resource']
+    assert [line for line in lines if re.fullmatch(r'module\t\{[-0-9A-F]{36}\}\tModule 00003', line)]
+
+
+@pytest.mark.parametrize('mode', ['--stats', '--list'])
+def test_stats_list_truncated(tmp_path, mode):
+    buildingblock = write_buildingblock(tmp_path / 'bb.xml', bbgenerate.generate_buildingblock(5, 5))
+    with open(buildingblock, 'rb') as file:
+        data = file.read()
+    with open(buildingblock, 'wb') as file:
+        file.write(data[:len(data) // 2])
+    assert 'Error reading' in run_bbreport(mode, '-f', buildingblock)
+
+
+@pytest.mark.parametrize('extension, compress', [
+    ('.xml.gz', gzip.compress),
+    ('.xml.bz2', bz2.compress),
+    ('.xml.xz', lzma.compress),
+    ('.zip', None)
+])
+def test_compressed_input(buildingblock, serial, tmp_path, extension, compress):
+    compressed = str(tmp_path / ('bb' + extension))
+    if compress is None:
+        with zipfile.ZipFile(compressed, 'w', zipfile.ZIP_DEFLATED) as file:
+            file.write(buildingblock, 'bb.xml')
+    else:
+        with open(buildingblock, 'rb') as source, open(compressed, 'wb') as file:
+            file.write(compress(source.read()))
+    output = tmp_path / 'out'
+    run_bbreport('-f', compressed, '-o', output)
+    # The index page shows the file name
+    assert differences(serial, output, ignore=['index.html']) == []
+
+
+def test_stdin_input(buildingblock, serial, tmp_path):
+    output = tmp_path / 'out'
+    run_bbreport('-f', '-', '-o', output, stdin=buildingblock)
+    assert differences(serial, output, ignore=['index.html']) == []